@@ -0,0 +1,193 @@
+import heapq
+
+import numpy as np
+
+from methods.class_tokens import class_probs
+
+
+class ConfidenceAggregator:
+    """
+    Streaming per-class, per-layer statistics of internal confidence over a dataset.
+
+    For every image and class the per-layer confidence is the maximum over image tokens of
+    internal_confidence_heatmap, and the image-level confidence is its maximum over layers
+    (i.e. internal_confidence). Images are folded in one at a time, so memory is
+    O(classes x layers x bins) regardless of dataset size, and aggregators built in different
+    worker processes can be combined with merge.
+    """
+
+    def __init__(
+        self, tokenizer, classes, num_bins=20, hit_threshold=0.5, top_n=10, variants=("plain",), aggregation="max"
+    ):
+        """
+        Args:
+            tokenizer: The tokenizer compatible with the model (e.g., AutoTokenizer).
+            classes: List of class words (str).
+            num_bins: Number of fixed histogram bins over [0, 1] (default: 20).
+            hit_threshold: Confidence above which a class counts as detected at a layer (default: 0.5).
+            top_n: Number of most confident images kept per class (default: 10).
+            variants: Spelling variants of the class words (see methods.class_tokens.VARIANTS).
+            aggregation: How subword tokens of multi-token classes are combined (default: "max").
+        """
+        self.tokenizer = tokenizer
+        self.classes = list(classes)
+        self.num_bins = num_bins
+        self.hit_threshold = hit_threshold
+        self.top_n = top_n
+        self.variants = tuple(variants)
+        self.aggregation = aggregation
+        self.bin_edges = np.linspace(0.0, 1.0, num_bins + 1)
+
+        self.num_images = 0
+        self.num_layers = None
+        # Статистики (num_classes, num_layers) создаются при первом изображении
+        self.mean = None
+        self.m2 = None
+        self.max = None
+        self.histogram = None
+        # Матрица ошибок по слоям для изображений с разметкой: TP, FP, FN, TN
+        self.confusion = None
+        self.num_labeled = 0
+        self.top = [[] for _ in self.classes]
+
+    def _init_stats(self, num_layers):
+        shape = (len(self.classes), num_layers)
+        self.num_layers = num_layers
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+        self.max = np.full(shape, -np.inf)
+        self.histogram = np.zeros(shape + (self.num_bins,), dtype=np.int64)
+        self.confusion = np.zeros((4,) + shape, dtype=np.int64)
+
+    def layer_confidence(self, softmax_probs):
+        """
+        Per-class, per-layer internal confidence of one image.
+
+        Args:
+            softmax_probs: Softmax probabilities for image tokens, shape (vocab_size, num_layers, num_tokens).
+
+        Returns:
+            np.ndarray: Confidence with shape (num_classes, num_layers).
+        """
+        return class_probs(
+            self.tokenizer, softmax_probs, self.classes, self.variants, self.aggregation
+        ).max(axis=2).astype(float)
+
+    def update(self, softmax_probs, image_id, labels=None):
+        """
+        Fold one image into the statistics.
+
+        Args:
+            softmax_probs: Softmax probabilities for image tokens (from retrieve_logit_lens_internvl).
+            image_id: Identifier kept in the per-class top-N lists (e.g. the image path). It must be
+                unique across all aggregators that are merged later, so counters local to a worker
+                cannot be used.
+            labels: Optional collection of ground-truth class words present in the image.
+        """
+        confidence = self.layer_confidence(softmax_probs)
+        if self.num_layers is None:
+            self._init_stats(confidence.shape[1])
+        elif confidence.shape[1] != self.num_layers:
+            raise ValueError(f"Expected {self.num_layers} layers, got {confidence.shape[1]}.")
+
+        # Онлайн-среднее и дисперсия (Welford)
+        self.num_images += 1
+        delta = confidence - self.mean
+        self.mean += delta / self.num_images
+        self.m2 += delta * (confidence - self.mean)
+        np.maximum(self.max, confidence, out=self.max)
+
+        bins = np.clip(np.searchsorted(self.bin_edges, confidence, side="right") - 1, 0, self.num_bins - 1)
+        class_index, layer_index = np.indices(bins.shape)
+        self.histogram[class_index, layer_index, bins] += 1
+
+        if labels is not None:
+            self.num_labeled += 1
+            present = np.array([class_ in labels for class_ in self.classes])[:, None]
+            detected = confidence >= self.hit_threshold
+            self.confusion[0] += detected & present
+            self.confusion[1] += detected & ~present
+            self.confusion[2] += ~detected & present
+            self.confusion[3] += ~detected & ~present
+
+        image_confidence = confidence.max(axis=1)
+        for heap, score in zip(self.top, image_confidence):
+            item = (float(score), image_id)
+            if len(heap) < self.top_n:
+                heapq.heappush(heap, item)
+            elif item[0] > heap[0][0]:
+                heapq.heapreplace(heap, item)
+
+    def merge(self, other):
+        """
+        Combine the statistics of another aggregator (e.g. from another worker process) into this one.
+
+        Args:
+            other: ConfidenceAggregator built with the same classes and bins.
+
+        Returns:
+            ConfidenceAggregator: self.
+        """
+        if other.classes != self.classes or other.num_bins != self.num_bins:
+            raise ValueError("Cannot merge aggregators with different classes or bins.")
+        if other.num_images == 0:
+            return self
+        if self.num_images == 0:
+            self._init_stats(other.num_layers)
+        elif other.num_layers != self.num_layers:
+            raise ValueError(f"Expected {self.num_layers} layers, got {other.num_layers}.")
+
+        # Объединение моментов (Chan et al.)
+        total = self.num_images + other.num_images
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * other.num_images / total
+        self.m2 = self.m2 + other.m2 + delta ** 2 * self.num_images * other.num_images / total
+        self.num_images = total
+
+        np.maximum(self.max, other.max, out=self.max)
+        self.histogram += other.histogram
+        self.confusion += other.confusion
+        self.num_labeled += other.num_labeled
+        self.top = [
+            heapq.nlargest(self.top_n, mine + theirs, key=lambda item: item[0])
+            for mine, theirs in zip(self.top, other.top)
+        ]
+        for heap in self.top:
+            heapq.heapify(heap)
+        return self
+
+    def __getstate__(self):
+        # Токенизатор не нужен для слияния и может быть тяжёлым при передаче между процессами
+        state = self.__dict__.copy()
+        state["tokenizer"] = None
+        return state
+
+    def summary(self):
+        """
+        Dataset-level report.
+
+        Returns:
+            dict: Arrays with shape (num_classes, num_layers) unless stated otherwise:
+                - classes: Class words (list).
+                - num_images: Number of aggregated images (int).
+                - mean, std, max: Statistics of the per-layer confidence.
+                - histogram: Counts with shape (num_classes, num_layers, num_bins), bin_edges with shape (num_bins + 1,).
+                - hit_rate, precision, recall: Detection metrics against labels (NaN where undefined).
+                - top: Per class, list of (confidence, image_id) sorted by decreasing confidence.
+        """
+        with np.errstate(divide="ignore", invalid="ignore"):
+            tp, fp, fn, tn = self.confusion if self.confusion is not None else (np.nan,) * 4
+            std = np.sqrt(self.m2 / self.num_images) if self.num_images else self.m2
+            return {
+                "classes": self.classes,
+                "num_images": self.num_images,
+                "mean": self.mean,
+                "std": std,
+                "max": self.max,
+                "histogram": self.histogram,
+                "bin_edges": self.bin_edges,
+                "hit_rate": (tp + tn) / self.num_labeled if self.num_labeled else None,
+                "precision": tp / (tp + fp) if self.num_labeled else None,
+                "recall": tp / (tp + fn) if self.num_labeled else None,
+                "top": [sorted(heap, key=lambda item: -item[0]) for heap in self.top],
+            }
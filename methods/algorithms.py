@@ -1,20 +1,27 @@
-def internal_confidence(tokenizer, softmax_probs, class_):
-    class_token_indices = tokenizer.encode(class_, add_special_tokens=False)[0:]
-    return softmax_probs[class_token_indices].max()
+from methods.class_tokens import class_probs
 
 
-def internal_confidence_heatmap(tokenizer, softmax_probs, class_):
-    class_token_indices = tokenizer.encode(class_, add_special_tokens=False)[0:]
-    print(class_token_indices)
-    return softmax_probs[class_token_indices].max(axis=0).T
+def internal_confidence(tokenizer, softmax_probs, class_, variants=("plain",), aggregation="max"):
+    return class_probs(tokenizer, softmax_probs, class_, variants, aggregation)[0].max()
 
 
-def internal_confidence_segmentation(tokenizer, softmax_probs, class_, num_patches=16):
-    class_token_indices = tokenizer.encode(class_, add_special_tokens=False )[0:]
+def internal_confidence_heatmap(tokenizer, softmax_probs, class_, variants=("plain",), aggregation="max"):
+    return class_probs(tokenizer, softmax_probs, class_, variants, aggregation)[0].T
+
+
+def internal_confidence_segmentation(
+    tokenizer, softmax_probs, class_, num_patches=16, grid=None, variants=("plain",), aggregation="max"
+):
+    segmentation = class_probs(tokenizer, softmax_probs, class_, variants, aggregation)[0].max(axis=0)
+    if grid is None:
+        return segmentation.reshape(num_patches, num_patches).astype(float)
+
+    # Склеиваем карты тайлов в сетку (columns, rows) из плана нарезки
+    columns, rows = grid
     return (
-        softmax_probs[class_token_indices]
-        .max(axis=0)
-        .max(axis=0)
-        .reshape(num_patches, num_patches)
+        segmentation[: columns * rows * num_patches * num_patches]
+        .reshape(rows, columns, num_patches, num_patches)
+        .transpose(0, 2, 1, 3)
+        .reshape(rows * num_patches, columns * num_patches)
         .astype(float)
-    )
\ No newline at end of file
+    )
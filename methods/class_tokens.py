@@ -0,0 +1,130 @@
+import numpy as np
+
+
+# Варианты написания класса: plain — как есть, space — с ведущим пробелом (слово внутри текста),
+# capitalized — с заглавной буквы, plural — во множественном числе
+VARIANTS = ("plain", "space", "capitalized", "plural")
+
+AGGREGATIONS = ("first", "max", "product")
+
+# Кэш токенизации: tokenizer -> {text: token_ids}
+_TOKEN_CACHE = {}
+
+
+def _pluralize(phrase):
+    head, _, last = phrase.rpartition(" ")
+    if last.endswith(("s", "x", "z", "ch", "sh")):
+        last += "es"
+    elif last.endswith("y") and last[-2:-1] not in ("a", "e", "i", "o", "u", ""):
+        last = last[:-1] + "ies"
+    else:
+        last += "s"
+    return f"{head} {last}" if head else last
+
+
+def class_variants(class_, variants=("plain",)):
+    """
+    Spellings of a class word for the requested variants.
+
+    Args:
+        class_: Class word or phrase (str).
+        variants: Subset of VARIANTS; variants combine, e.g. ("space", "capitalized", "plural")
+            also yields " Hot dogs" (default: ("plain",)).
+
+    Returns:
+        list: Unique spellings (str).
+    """
+    unknown = set(variants) - set(VARIANTS)
+    if unknown:
+        raise ValueError(f"Unknown variants {sorted(unknown)}, expected a subset of {VARIANTS}.")
+
+    forms = [class_]
+    if "plural" in variants:
+        forms += [_pluralize(form) for form in forms]
+    if "capitalized" in variants:
+        forms += [form[:1].upper() + form[1:] for form in forms]
+    if "space" in variants:
+        forms += [" " + form for form in forms]
+    if "plain" not in variants:
+        # plain задаёт только исходное написание; без него остаются производные варианты
+        derived = [form for form in forms if form != class_]
+        forms = derived or forms
+    return list(dict.fromkeys(forms))
+
+
+def encode_cached(tokenizer, texts):
+    """
+    Tokenize texts without special tokens, batch-encoding only the ones not seen before for this tokenizer.
+
+    Args:
+        tokenizer: The tokenizer compatible with the model (e.g., AutoTokenizer).
+        texts: List of strings.
+
+    Returns:
+        list: Token IDs (list of int) for every text.
+    """
+    cache = _TOKEN_CACHE.setdefault(id(tokenizer), (tokenizer, {}))[1]
+    missing = list(dict.fromkeys(text for text in texts if text not in cache))
+    if missing:
+        encoded = tokenizer(missing, add_special_tokens=False)["input_ids"]
+        cache.update(zip(missing, encoded))
+    return [cache[text] for text in texts]
+
+
+def resolve_class_tokens(tokenizer, classes, variants=("plain",)):
+    """
+    Token IDs of every spelling variant of every class.
+
+    Args:
+        tokenizer: The tokenizer compatible with the model (e.g., AutoTokenizer).
+        classes: Class word (str) or list of class words.
+        variants: Subset of VARIANTS (default: ("plain",)).
+
+    Returns:
+        list: Per class, a list of token ID lists (one per variant).
+    """
+    if isinstance(classes, str):
+        classes = [classes]
+    forms = [class_variants(class_, variants) for class_ in classes]
+    encoded = iter(encode_cached(tokenizer, [form for class_forms in forms for form in class_forms]))
+    return [[next(encoded) for _ in class_forms] for class_forms in forms]
+
+
+def _aggregate_phrase(rows, aggregation):
+    # rows: (num_subword_tokens, num_layers, num_tokens)
+    if aggregation == "first":
+        return rows[0]
+    if aggregation == "max":
+        return rows.max(axis=0)
+    if aggregation == "product":
+        return rows.prod(axis=0)
+    raise ValueError(f"Unknown aggregation {aggregation}, expected one of {AGGREGATIONS}.")
+
+
+def class_probs(tokenizer, softmax_probs, classes, variants=("plain",), aggregation="max"):
+    """
+    Per-layer, per-image-token probabilities of classes, gathering all needed vocabulary rows at once.
+
+    Each spelling variant is reduced over its subword tokens with aggregation, then the maximum is
+    taken over variants.
+
+    Args:
+        tokenizer: The tokenizer compatible with the model (e.g., AutoTokenizer).
+        softmax_probs: Softmax probabilities for image tokens, shape (vocab_size, num_layers, num_tokens)
+            (numpy array or EncodedLogitLens).
+        classes: Class word (str) or list of class words.
+        variants: Subset of VARIANTS (default: ("plain",)).
+        aggregation: One of AGGREGATIONS, how subword tokens of a phrase are combined (default: "max").
+
+    Returns:
+        np.ndarray: Probabilities with shape (num_classes, num_layers, num_tokens).
+    """
+    resolved = resolve_class_tokens(tokenizer, classes, variants)
+    unique_ids = sorted({t for class_ids in resolved for ids in class_ids for t in ids})
+    position = {t: i for i, t in enumerate(unique_ids)}
+    rows = np.asarray(softmax_probs[unique_ids])
+
+    return np.stack([
+        np.max([_aggregate_phrase(rows[[position[t] for t in ids]], aggregation) for ids in class_ids], axis=0)
+        for class_ids in resolved
+    ])
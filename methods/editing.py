@@ -0,0 +1,168 @@
+import torch
+
+from methods.internvl_utils import (
+    IMG_CONTEXT_TOKEN,
+    generate_images_tensor,
+    generate_text_prompt,
+    prompt_to_img_input_ids,
+    run_internvl_model,
+)
+
+
+def get_concept_embeddings_internvl(state, concepts, layer):
+    """
+    Get the hidden state embeddings of several concept words at one layer with a single batched forward.
+
+    Args:
+        state: Dictionary containing model and tokenizer (from load_internvl_state).
+        concepts: List of concept words (str).
+        layer: Index of the hidden state (0 is the embedding output, i is the input of decoder layer i).
+
+    Returns:
+        torch.Tensor: Embeddings of the last token of every concept, shape (num_concepts, hidden_size).
+    """
+    model = state["model"]
+    tokenizer = state["tokenizer"]
+
+    token_ids = [tokenizer.encode(concept, add_special_tokens=False) for concept in concepts]
+    lengths = torch.tensor([len(ids) for ids in token_ids], device=model.device)
+    max_length = int(lengths.max())
+
+    # Паддинг справа: позиции слов не сдвигаются, а маска отсекает хвост
+    input_ids = torch.full((len(concepts), max_length), tokenizer.pad_token_id, device=model.device)
+    for i, ids in enumerate(token_ids):
+        input_ids[i, :len(ids)] = torch.tensor(ids, device=model.device)
+    attention_mask = (torch.arange(max_length, device=model.device)[None] < lengths[:, None]).long()
+
+    with torch.inference_mode():
+        output = model.language_model(
+            input_ids=input_ids, attention_mask=attention_mask, output_hidden_states=True
+        )
+    hidden_states = output.hidden_states[layer]
+    return hidden_states[torch.arange(len(concepts), device=model.device), lengths - 1]
+
+
+class ConceptProjectionEditor:
+    """
+    Removes many concepts from the image embeddings at once by orthogonal projection.
+
+    The concept embeddings are fetched once and orthonormalised into a basis Q, and a single
+    pre-hook on the chosen decoder layer replaces every <IMG_CONTEXT> hidden state h with
+    h - weight * (h Q) Q^T, so the cost does not depend on the number of concepts.
+    """
+
+    def __init__(self, state, concepts, layer=5, weight=1.0):
+        """
+        Args:
+            state: Dictionary returned by load_internvl_state.
+            concepts: List of concept words to remove (str).
+            layer: Decoder layer whose input is edited (default: 5).
+            weight: Strength of the projection, 1.0 removes the concept subspace entirely (default: 1.0).
+        """
+        self.state = state
+        self.concepts = list(concepts)
+        self.layer = layer
+        self.weight = weight
+        self.image_positions = None
+        self._seq_length = None
+        self._handle = None
+
+        embeddings = get_concept_embeddings_internvl(state, self.concepts, layer).float()
+        # Ортонормированный базис подпространства концептов (hidden_size, rank)
+        q, r = torch.linalg.qr(embeddings.T)
+        rank = (r.diagonal().abs() > 1e-6 * r.diagonal().abs().max()).sum()
+        self.basis = q[:, :rank].contiguous()
+
+    def set_image_positions(self, input_ids):
+        """
+        Set the <IMG_CONTEXT> positions to edit from the prompt input IDs.
+
+        Args:
+            input_ids: Input IDs tensor with shape [1, seq_length] (from prompt_to_img_input_ids).
+        """
+        img_context_token_id = self.state["tokenizer"].convert_tokens_to_ids(IMG_CONTEXT_TOKEN)
+        self.image_positions = (input_ids[0] == img_context_token_id).nonzero(as_tuple=True)[0]
+        self._seq_length = input_ids.shape[1]
+
+    def _pre_hook(self, module, args, kwargs):
+        if args:
+            hidden_states = args[0]
+        else:
+            hidden_states = kwargs["hidden_states"]
+
+        # Правим только префилл: на шагах декодирования токенов изображения нет
+        if self.image_positions is None or hidden_states.shape[1] != self._seq_length:
+            return None
+
+        image_hidden = hidden_states[:, self.image_positions].float()
+        projection = (image_hidden @ self.basis) @ self.basis.T
+        hidden_states = hidden_states.clone()
+        hidden_states[:, self.image_positions] = (image_hidden - self.weight * projection).to(hidden_states.dtype)
+
+        if args:
+            return (hidden_states,) + tuple(args[1:]), kwargs
+        kwargs["hidden_states"] = hidden_states
+        return args, kwargs
+
+    def attach(self):
+        """Register the pre-hook on the decoder layer."""
+        if self._handle is None:
+            layer = self.state["model"].language_model.model.layers[self.layer]
+            self._handle = layer.register_forward_pre_hook(self._pre_hook, with_kwargs=True)
+        return self
+
+    def remove(self):
+        """Remove the pre-hook from the decoder layer."""
+        if self._handle is not None:
+            self._handle.remove()
+            self._handle = None
+
+    def __enter__(self):
+        return self.attach()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.remove()
+
+
+def generate_edited_caption_internvl(
+    state, img_path, concepts, layer=5, weight=1.0, num_patches=1, text_prompt=None, tile_plan=None, image_encoder=None
+):
+    """
+    Generate a caption after removing the given concepts from the image embeddings.
+
+    Args:
+        state: Dictionary returned by load_internvl_state.
+        img_path: Path to the image file (str).
+        concepts: List of concept words to remove (str).
+        layer: Decoder layer whose input is edited (default: 5).
+        weight: Strength of the projection (default: 1.0).
+        num_patches: Number of image patches (default: 1).
+        text_prompt: Input text prompt (default: None, uses "Write a detailed description.").
+        tile_plan: Optional tile plan (from plan_image_tiles / plan_batch_tiles) overriding num_patches.
+        image_encoder: Optional exported image encoder (from methods.vision_export.load_image_encoder).
+
+    Returns:
+        str: Generated caption for the edited image embeddings.
+    """
+    model = state["model"]
+    if text_prompt is None:
+        text_prompt = "Write a detailed description."
+
+    editor = ConceptProjectionEditor(state, concepts, layer=layer, weight=weight)
+    pixel_values, images, image_sizes = generate_images_tensor(
+        model, img_path, num_patches=num_patches, tile_plan=tile_plan
+    )
+    prompt = generate_text_prompt(model, state["model_name"], text_prompt, num_patches=pixel_values.shape[0])
+    editor.set_image_positions(prompt_to_img_input_ids(prompt, state["tokenizer"], device=model.device))
+
+    with editor:
+        return run_internvl_model(
+            model,
+            state["model_name"],
+            pixel_values,
+            image_sizes,
+            state["tokenizer"],
+            text_prompt=text_prompt,
+            num_patches=num_patches,
+            image_encoder=image_encoder,
+        )
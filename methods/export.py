@@ -0,0 +1,168 @@
+import hashlib
+
+import numpy as np
+
+from methods.class_tokens import class_probs
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+
+def prompt_hash(prompt):
+    """Short stable hash of a text prompt, used to group results of the same prompt."""
+    return hashlib.sha1((prompt or "").encode("utf-8")).hexdigest()[:16]
+
+
+class ScoreParquetWriter:
+    """
+    Streams per-image, per-class, per-layer scores into a columnar Parquet file.
+
+    Columns: image_id, prompt_hash, class, layer, token, score and optionally layer_max (the
+    maximum of score over tokens for the same image, class and layer). image_id, prompt_hash and
+    class are dictionary-encoded, so filters on them and on layer are pushed down by readers.
+    Rows are buffered as numpy arrays and flushed as whole row groups.
+    """
+
+    def __init__(self, path, row_group_size=1_000_000, include_layer_max=True, compression="zstd"):
+        """
+        Args:
+            path: Output Parquet file path (str).
+            row_group_size: Number of rows per row group (default: 1_000_000).
+            include_layer_max: Whether to write the layer_max column (default: True).
+            compression: Parquet compression codec (default: "zstd").
+        """
+        if pa is None:
+            raise ImportError("ScoreParquetWriter requires pyarrow: pip install pyarrow")
+
+        self.path = path
+        self.row_group_size = row_group_size
+        self.include_layer_max = include_layer_max
+
+        fields = [
+            pa.field("image_id", pa.dictionary(pa.int32(), pa.string())),
+            pa.field("prompt_hash", pa.dictionary(pa.int32(), pa.string())),
+            pa.field("class", pa.dictionary(pa.int32(), pa.string())),
+            pa.field("layer", pa.int16()),
+            pa.field("token", pa.int32()),
+            pa.field("score", pa.float32()),
+        ]
+        if include_layer_max:
+            fields.append(pa.field("layer_max", pa.float32()))
+        self.schema = pa.schema(fields)
+        self._writer = pq.ParquetWriter(path, self.schema, compression=compression, use_dictionary=True)
+
+        # Словари строковых колонок и буферы ещё не записанных строк
+        self._dictionaries = {"image_id": {}, "prompt_hash": {}, "class": {}}
+        self._buffers = {name: [] for name in self.schema.names}
+        self._buffered_rows = 0
+
+    def _code(self, column, value):
+        dictionary = self._dictionaries[column]
+        if value not in dictionary:
+            dictionary[value] = len(dictionary)
+        return dictionary[value]
+
+    def write_scores(self, image_id, prompt, class_, scores, kind=None):
+        """
+        Append the scores of one image and class.
+
+        Args:
+            image_id: Image identifier (str).
+            prompt: Text prompt used for the image (str or None).
+            class_: Class word (str).
+            scores: Score array produced by one of the functions in methods/algorithms.py.
+            kind: Layout of scores (default: None, allowed only for scalars):
+                - "confidence": scalar (internal_confidence), written with layer = token = -1.
+                - "heatmap": (num_tokens, num_layers) (internal_confidence_heatmap).
+                - "segmentation": (height, width) patch map (internal_confidence_segmentation), already
+                  reduced over layers, written with layer = -1 and token = row * width + column.
+                2-D heatmaps and segmentation maps cannot be told apart by shape, so kind is required for them.
+        """
+        scores = np.asarray(scores, dtype=np.float32)
+        if kind is None:
+            if scores.ndim != 0:
+                raise ValueError(
+                    f"kind is required for scores with shape {scores.shape}: 'heatmap' or 'segmentation'."
+                )
+            kind = "confidence"
+
+        if kind == "confidence" and scores.ndim == 0:
+            scores = scores.reshape(1, 1)
+            layers = np.array([-1], dtype=np.int16)
+            tokens = np.array([-1], dtype=np.int32)
+        elif kind == "heatmap" and scores.ndim == 2:
+            layers = np.arange(scores.shape[1], dtype=np.int16)
+            tokens = np.arange(scores.shape[0], dtype=np.int32)
+        elif kind == "segmentation" and scores.ndim == 2:
+            # Карта патчей построчно: один "слой" -1 с токенами в порядке row * width + column
+            scores = scores.reshape(-1, 1)
+            layers = np.array([-1], dtype=np.int16)
+            tokens = np.arange(scores.shape[0], dtype=np.int32)
+        else:
+            raise ValueError(
+                f"Scores with shape {scores.shape} do not match kind {kind!r}, expected a scalar for "
+                "'confidence' or a 2-D array for 'heatmap' and 'segmentation'."
+            )
+
+        num_tokens, num_layers = scores.shape
+        num_rows = scores.size
+        # Строки в порядке (layer, token), чтобы фильтр по слою читал смежные диапазоны
+        self._buffers["layer"].append(np.repeat(layers, num_tokens))
+        self._buffers["token"].append(np.tile(tokens, num_layers))
+        self._buffers["score"].append(scores.T.ravel())
+        if self.include_layer_max:
+            self._buffers["layer_max"].append(np.repeat(scores.max(axis=0), num_tokens))
+
+        for column, value in (("image_id", str(image_id)), ("prompt_hash", prompt_hash(prompt)), ("class", class_)):
+            self._buffers[column].append(np.full(num_rows, self._code(column, value), dtype=np.int32))
+
+        self._buffered_rows += num_rows
+        if self._buffered_rows >= self.row_group_size:
+            self.flush()
+
+    def write_logit_lens(self, image_id, prompt, tokenizer, softmax_probs, classes):
+        """
+        Append internal_confidence_heatmap scores of several classes for one image, gathered in one pass.
+
+        Args:
+            image_id: Image identifier (str).
+            prompt: Text prompt used for the image (str or None).
+            tokenizer: The tokenizer compatible with the model (e.g., AutoTokenizer).
+            softmax_probs: Softmax probabilities for image tokens (from retrieve_logit_lens_internvl).
+            classes: List of class words (str).
+        """
+        for class_, probs in zip(classes, class_probs(tokenizer, softmax_probs, classes)):
+            self.write_scores(image_id, prompt, class_, probs.T, kind="heatmap")
+
+    def flush(self):
+        """Write the buffered rows as row groups."""
+        if not self._buffered_rows:
+            return
+
+        columns = []
+        for field in self.schema:
+            values = np.concatenate(self._buffers[field.name])
+            if pa.types.is_dictionary(field.type):
+                dictionary = pa.array(list(self._dictionaries[field.name]), type=pa.string())
+                columns.append(pa.DictionaryArray.from_arrays(pa.array(values, type=pa.int32()), dictionary))
+            else:
+                columns.append(pa.array(values, type=field.type))
+
+        self._writer.write_table(pa.Table.from_arrays(columns, schema=self.schema), row_group_size=self.row_group_size)
+        self._buffers = {name: [] for name in self.schema.names}
+        self._buffered_rows = 0
+
+    def close(self):
+        """Flush the remaining rows and finalize the file."""
+        self.flush()
+        self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -1,7 +1,10 @@
 from PIL import Image
+import heapq
+import math
 import torch
 from transformers import GenerationConfig, TopKLogitsWarper, LogitsProcessorList, AutoModel, AutoTokenizer, AutoConfig
 from src.caption.internvl.conversation import get_conv_template
+from methods.lens_codecs import encode_logit_lens
 import torch
 import torchvision.transforms as T
 from torchvision.transforms.functional import InterpolationMode
@@ -99,20 +102,121 @@ def find_closest_aspect_ratio(aspect_ratio, target_ratios, width, height, image_
     return best_ratio
 
 
-def dynamic_preprocess(image, min_num=1, max_num=12, image_size=448, use_thumbnail=False):
-    orig_width, orig_height = image.size
-    aspect_ratio = orig_width / orig_height
-    
+def plan_tiles(width, height, min_num=1, max_num=12, image_size=448, max_tiles=None, adaptive=False,
+               use_thumbnail=False):
+    """
+    Choose the tile grid for an image of the given size.
+
+    Args:
+        width: Image width in pixels.
+        height: Image height in pixels.
+        min_num: Minimum number of tiles (default: 1).
+        max_num: Maximum number of tiles (default: 12).
+        image_size: Tile size in pixels (default: 448).
+        max_tiles: Optional tile budget for this image, e.g. token_budget // model.num_image_token
+            (default: None, only max_num applies).
+        adaptive: Whether to cap the tile count by the native resolution of the image, so small
+            images are not upscaled into many tiles (default: False).
+        use_thumbnail: Whether a thumbnail tile is appended to multi-tile grids (default: False).
+
+    Returns:
+        dict: Tile plan with keys
+            - grid: (columns, rows) of the tile grid.
+            - num_tiles: Real number of tiles, including the thumbnail (int).
+            - use_thumbnail: Whether a thumbnail tile is appended (bool).
+    """
+    if max_tiles is not None and max_tiles < min_num:
+        raise ValueError(f"Tile budget {max_tiles} is below the minimum of {min_num} tiles.")
+    limit = max_num if max_tiles is None else min(max_num, max_tiles)
+    if adaptive:
+        limit = min(limit, math.ceil(width * height / (image_size * image_size)))
+    limit = max(min_num, limit)
+
     # calculate the existing image aspect ratio
     target_ratios = set(
-        (i, j) for n in range(min_num, max_num + 1) for i in range(1, n + 1) for j in range(1, n + 1) if
-        i * j <= max_num and i * j >= min_num)
+        (i, j) for n in range(min_num, limit + 1) for i in range(1, n + 1) for j in range(1, n + 1) if
+        i * j <= limit and i * j >= min_num)
     target_ratios = sorted(target_ratios, key=lambda x: x[0] * x[1])
-    
+
     # find the closest aspect ratio to the target
-    target_aspect_ratio = find_closest_aspect_ratio(
-        aspect_ratio, target_ratios, orig_width, orig_height, image_size)
-    
+    grid = find_closest_aspect_ratio(width / height, target_ratios, width, height, image_size)
+    blocks = grid[0] * grid[1]
+    with_thumbnail = use_thumbnail and blocks != 1
+    return {"grid": grid, "num_tiles": blocks + int(with_thumbnail), "use_thumbnail": with_thumbnail}
+
+
+def plan_batch_tiles(image_sizes, token_budget, num_image_token=256, min_num=1, max_num=12, image_size=448):
+    """
+    Split a batch-level token budget into per-image tile plans.
+
+    Every image starts with its smallest tile plan, then the remaining tiles are spent one grid step
+    at a time on the image that is furthest from the tile count its native resolution would use.
+    A step moves an image to its next larger grid and costs exactly the tiles that grid adds, so
+    the budget is charged for the tiles actually used and nothing is left allocated but unused.
+
+    Args:
+        image_sizes: List of original image sizes (width, height).
+        token_budget: Total number of image tokens for the batch.
+        num_image_token: Number of image tokens per tile (default: 256, model.num_image_token).
+        min_num: Minimum number of tiles per image (default: 1).
+        max_num: Maximum number of tiles per image (default: 12).
+        image_size: Tile size in pixels (default: 448).
+
+    Returns:
+        list: Tile plans (see plan_tiles), in the order of image_sizes.
+    """
+    budget_tiles = token_budget // num_image_token
+
+    # Для каждого изображения - последовательность планов с растущим реальным числом тайлов
+    steps = []
+    for w, h in image_sizes:
+        wanted = plan_tiles(w, h, min_num=min_num, max_num=max_num, image_size=image_size, adaptive=True)
+        image_steps = []
+        for max_tiles in range(min_num, wanted["num_tiles"] + 1):
+            plan = plan_tiles(
+                w, h, min_num=min_num, max_num=max_num, image_size=image_size, max_tiles=max_tiles, adaptive=True
+            )
+            if not image_steps or plan["num_tiles"] > image_steps[-1]["num_tiles"]:
+                image_steps.append(plan)
+        steps.append(image_steps)
+
+    chosen = [0] * len(image_sizes)
+    remaining = budget_tiles - sum(image_steps[0]["num_tiles"] for image_steps in steps)
+    if remaining < 0:
+        raise ValueError(
+            f"Token budget {token_budget} is too small for {len(image_sizes)} images with {min_num} tiles each."
+        )
+
+    def deficit(i):
+        wanted = steps[i][-1]["num_tiles"]
+        return -(wanted - steps[i][chosen[i]]["num_tiles"]) / wanted
+
+    # Очередь по относительному недобору тайлов; шаг, не влезающий в остаток, выбывает
+    heap = [(deficit(i), i) for i in range(len(image_sizes)) if len(steps[i]) > 1]
+    heapq.heapify(heap)
+    while remaining > 0 and heap:
+        _, i = heapq.heappop(heap)
+        cost = steps[i][chosen[i] + 1]["num_tiles"] - steps[i][chosen[i]]["num_tiles"]
+        if cost > remaining:
+            continue
+        chosen[i] += 1
+        remaining -= cost
+        if chosen[i] + 1 < len(steps[i]):
+            heapq.heappush(heap, (deficit(i), i))
+
+    return [image_steps[index] for image_steps, index in zip(steps, chosen)]
+
+
+def dynamic_preprocess(image, min_num=1, max_num=12, image_size=448, use_thumbnail=False, tile_plan=None):
+    orig_width, orig_height = image.size
+
+    # choose the tile grid unless it was planned in advance
+    if tile_plan is None:
+        tile_plan = plan_tiles(
+            orig_width, orig_height, min_num=min_num, max_num=max_num, image_size=image_size,
+            use_thumbnail=use_thumbnail)
+    target_aspect_ratio = tile_plan["grid"]
+
     # calculate the target width and height
     target_width = image_size * target_aspect_ratio[0]
     target_height = image_size * target_aspect_ratio[1]
@@ -132,23 +236,57 @@ def dynamic_preprocess(image, min_num=1, max_num=12, image_size=448, use_thumbna
         split_img = resized_img.crop(box)
         processed_images.append(split_img)
     assert len(processed_images) == blocks
-    if use_thumbnail and len(processed_images) != 1:
+    if tile_plan["use_thumbnail"] and len(processed_images) != 1:
         thumbnail_img = image.resize((image_size, image_size))
         processed_images.append(thumbnail_img)
     return processed_images
 
 
-def load_image_internvl(image_file, input_size=448, max_num=12):
+def load_image_internvl(image_file, input_size=448, max_num=12, tile_plan=None):
     image = Image.open(image_file).convert('RGB')
     transform = build_transform(input_size=input_size)
-    images = dynamic_preprocess(image, image_size=input_size, use_thumbnail=False, max_num=max_num)
+    images = dynamic_preprocess(image, image_size=input_size, use_thumbnail=False, max_num=max_num,
+                                tile_plan=tile_plan)
     pixel_values = [transform(image) for image in images]
     pixel_values = torch.stack(pixel_values)
     return pixel_values
 
 
-def generate_images_tensor(model, img_path, image_processor=None, num_patches=1):
-    images_tensor = load_image_internvl(img_path, max_num=num_patches).to(torch.float16).cuda()
+def plan_image_tiles(model, img_path, num_patches=1, token_budget=None, adaptive=False):
+    """
+    Plan the tile grid of an image under an optional token budget.
+
+    The returned plan can be passed as tile_plan to generate_images_tensor / retrieve_logit_lens_internvl,
+    and its grid to internal_confidence_segmentation.
+
+    Args:
+        model: The InternVLChatModel instance.
+        img_path: Path to the image file (str).
+        num_patches: Maximum number of tiles (default: 1).
+        token_budget: Optional maximum number of image tokens (default: None).
+        adaptive: Whether to cap the tile count by the native image resolution (default: False).
+
+    Returns:
+        dict: Tile plan (see plan_tiles) with the additional key num_image_tokens (int).
+    """
+    with Image.open(img_path) as image:
+        width, height = image.size
+    max_tiles = None if token_budget is None else token_budget // model.num_image_token
+    if max_tiles is not None and max_tiles < 1:
+        raise ValueError(
+            f"Token budget {token_budget} is smaller than one tile ({model.num_image_token} image tokens)."
+        )
+    tile_plan = plan_tiles(
+        width, height, max_num=num_patches, image_size=model.config.vision_config.image_size,
+        max_tiles=max_tiles, adaptive=adaptive
+    )
+    tile_plan["num_image_tokens"] = tile_plan["num_tiles"] * model.num_image_token
+    return tile_plan
+
+
+def generate_images_tensor(model, img_path, image_processor=None, num_patches=1, tile_plan=None):
+    images_tensor = load_image_internvl(img_path, max_num=num_patches, tile_plan=tile_plan).to(
+        model.device, dtype=model.dtype)
     
     image_size = model.config.vision_config.image_size
     return images_tensor, None, image_size
@@ -181,8 +319,8 @@ def run_internvl_model(
     text_prompt=None,
     hidden_states=False,
     num_patches=1,
-    temperature=1.0
-    
+    temperature=1.0,
+    image_encoder=None
 ):
     """
     Run the InternVL2_5-1B model to generate text based on an image and text prompt.
@@ -195,7 +333,10 @@ def run_internvl_model(
         tokenizer: The tokenizer compatible with the model (e.g., AutoTokenizer).
         text_prompt: The input text prompt (default: "Write a detailed description.").
         hidden_states: Whether to return hidden states (default: False).
-        num_patches: Number of image patches (default: 1).
+        num_patches: Number of image patches, used only when pixel_values is None (default: 1).
+            Otherwise the prompt gets one tile of image tokens per row of pixel_values.
+        image_encoder: Optional exported image encoder (from methods.vision_export.load_image_encoder)
+            used instead of the eager vision tower and projector (default: None).
 
     Returns:
         str or tuple: Decoded text output or (input_ids, output) if hidden_states=True.
@@ -203,6 +344,10 @@ def run_internvl_model(
     if text_prompt is None:
         text_prompt = "Write a detailed description."
 
+    # Число тайлов берём из фактически нарезанного изображения
+    if pixel_values is not None:
+        num_patches = pixel_values.shape[0]
+
     # Формируем промпт с токенами изображения
     prompt = generate_text_prompt(model, model_name, text_prompt, num_patches=num_patches)
     
@@ -228,9 +373,15 @@ def run_internvl_model(
     attention_mask = (input_ids != tokenizer.pad_token_id).long().to(model.device)
     
     with torch.inference_mode():
+        # Экспортированный энкодер заменяет vision tower + проектор внутри generate
+        visual_features = None
+        if image_encoder is not None:
+            visual_features = image_encoder(pixel_values).to(model.device, dtype=model.dtype)
+
         output = model.generate(
             pixel_values=pixel_values,
             input_ids=input_ids,
+            visual_features=visual_features,
             attention_mask=attention_mask,
             generation_config=generation_config,
             output_hidden_states=hidden_states,
@@ -248,7 +399,346 @@ def run_internvl_model(
     return outputs
 
 
-def retrieve_logit_lens_internvl(state, img_path, num_patches, text_prompt=None, temperature=1.0):
+def build_internvl_input_embeds(model, input_ids, pixel_values=None, visual_features=None):
+    """
+    Build the language model input embeddings with the image embeddings woven into <IMG_CONTEXT> positions.
+
+    Mirrors the embedding step of InternVLChatModel.generate, so the result can be fed to
+    model.language_model directly.
+
+    Args:
+        model: The InternVLChatModel instance.
+        input_ids: Input IDs tensor with shape [batch_size, seq_length] (from prompt_to_img_input_ids).
+        pixel_values: Tensor of processed images (from generate_images_tensor).
+        visual_features: Precomputed image embeddings (default: None, computed from pixel_values).
+
+    Returns:
+        torch.Tensor: Input embeddings with shape [batch_size, seq_length, hidden_size].
+    """
+    if visual_features is None:
+        visual_features = model.extract_feature(pixel_values)
+
+    input_embeds = model.language_model.get_input_embeddings()(input_ids)
+    B, N, C = input_embeds.shape
+    input_embeds = input_embeds.reshape(B * N, C)
+
+    selected = input_ids.reshape(B * N) == model.img_context_token_id
+    input_embeds[selected] = visual_features.reshape(-1, C).to(input_embeds.device, dtype=input_embeds.dtype)
+    return input_embeds.reshape(B, N, C)
+
+
+def _fork_past_key_values(past_key_values, num_streams):
+    # Размножаем KV-кэш префилла по батчу: каждый поток декодирования получает свою копию
+    if hasattr(past_key_values, "batch_repeat_interleave"):
+        past_key_values.batch_repeat_interleave(num_streams)
+        return past_key_values
+    return tuple(
+        tuple(t.repeat_interleave(num_streams, dim=0) for t in layer_past)
+        for layer_past in past_key_values
+    )
+
+
+def prefill_internvl(
+    state, img_path, num_patches=1, text_prompt=None, output_hidden_states=False, tile_plan=None, image_encoder=None
+):
+    """
+    Encode the image and run the language model once over the whole prompt.
+
+    The returned output holds the KV cache and the logits of the next token, so it can be passed
+    straight to decode_internvl; with output_hidden_states=True it also holds the prompt hidden
+    states of every layer (e.g. for the logit lens of the image tokens).
+
+    Args:
+        state: Dictionary containing model, model_name and tokenizer (from load_internvl_state).
+        img_path: Path to the image file (str).
+        num_patches: Number of image patches (default: 1).
+        text_prompt: Input text prompt (default: None, uses "Write a detailed description.").
+        output_hidden_states: Whether to return the hidden states of every layer (default: False).
+        tile_plan: Optional tile plan (from plan_image_tiles / plan_batch_tiles) overriding num_patches.
+        image_encoder: Optional exported image encoder (from methods.vision_export.load_image_encoder).
+
+    Returns:
+        tuple: (input_ids, attention_mask, output, eos_token_id, stop_str)
+            - input_ids: Prompt token IDs, shape (1, seq_len).
+            - attention_mask: Prompt attention mask, shape (1, seq_len).
+            - output: Language model output of the prefill (logits, past_key_values, hidden_states).
+            - eos_token_id: Stop token ID of the conversation template (int).
+            - stop_str: Stop string of the conversation template (str).
+    """
+    model = state["model"]
+    tokenizer = state["tokenizer"]
+    if text_prompt is None:
+        text_prompt = "Write a detailed description."
+
+    pixel_values, images, image_sizes = generate_images_tensor(
+        model, img_path, num_patches=num_patches, tile_plan=tile_plan
+    )
+    prompt = generate_text_prompt(model, state["model_name"], text_prompt, num_patches=pixel_values.shape[0])
+    input_ids = prompt_to_img_input_ids(prompt, tokenizer, device=model.device)
+
+    template = get_conv_template(model.template)
+    stop_str = template.sep.strip()
+    eos_token_id = tokenizer.convert_tokens_to_ids(stop_str)
+
+    visual_features = None if image_encoder is None else image_encoder(pixel_values)
+    input_embeds = build_internvl_input_embeds(
+        model, input_ids, pixel_values=pixel_values, visual_features=visual_features
+    )
+    attention_mask = torch.ones_like(input_ids)
+    output = model.language_model(
+        inputs_embeds=input_embeds,
+        attention_mask=attention_mask,
+        use_cache=True,
+        output_hidden_states=output_hidden_states,
+    )
+    return input_ids, attention_mask, output, eos_token_id, stop_str
+
+
+def decode_internvl(
+    model,
+    output,
+    attention_mask,
+    eos_token_id,
+    temperatures=0.0,
+    max_new_tokens=512,
+    top_k=None,
+    output_hidden_states=False,
+):
+    """
+    Decode one or more streams on top of a prefill (from prefill_internvl), one token per step.
+
+    With several temperatures the KV cache of the prompt is forked into one stream per
+    temperature and all streams are decoded together as a batch. Finished streams keep
+    emitting eos_token_id until every stream has finished.
+
+    Args:
+        model: The InternVLChatModel instance.
+        output: Language model output of the prefill (from prefill_internvl).
+        attention_mask: Prompt attention mask (from prefill_internvl).
+        eos_token_id: Stop token ID (from prefill_internvl).
+        temperatures: Sampling temperature or list of temperatures, one per stream (default: 0.0).
+            0 means greedy decoding.
+        max_new_tokens: Maximum number of generated tokens (default: 512).
+        top_k: Optional top-k filtering applied before sampling (default: None).
+        output_hidden_states: Whether the decode steps return the hidden states of every layer (default: False).
+
+    Yields:
+        dict: Per step, with keys
+            - token_ids: Chosen token of every stream, tensor with shape (num_streams,).
+            - logprobs: Log-probabilities of the chosen tokens under the untempered model, shape (num_streams,).
+            - output: Language model output whose logits produced the step (the prefill output at step 0).
+    """
+    if not isinstance(temperatures, (list, tuple)):
+        temperatures = [temperatures]
+    num_streams = len(temperatures)
+    temps = torch.tensor([float(t) for t in temperatures], device=model.device).unsqueeze(1)
+    greedy = temps == 0
+
+    past_key_values = output.past_key_values
+    logits = output.logits[:, -1].float()
+    if num_streams > 1:
+        past_key_values = _fork_past_key_values(past_key_values, num_streams)
+        logits = logits.repeat(num_streams, 1)
+        attention_mask = attention_mask.repeat(num_streams, 1)
+
+    finished = torch.zeros(num_streams, dtype=torch.bool, device=model.device)
+    for _ in range(max_new_tokens):
+        logprobs = torch.log_softmax(logits, dim=-1)
+        if greedy.all():
+            next_tokens = logits.argmax(dim=-1)
+        else:
+            scaled = logits / torch.where(greedy, torch.ones_like(temps), temps)
+            if top_k is not None:
+                kth = torch.topk(scaled, top_k, dim=-1).values[:, -1:]
+                scaled = scaled.masked_fill(scaled < kth, float("-inf"))
+            sampled = torch.multinomial(torch.softmax(scaled, dim=-1), 1).squeeze(1)
+            next_tokens = torch.where(greedy.squeeze(1), logits.argmax(dim=-1), sampled)
+        # Завершённые потоки продолжают считаться в батче, но их токены игнорируются
+        next_tokens = next_tokens.masked_fill(finished, eos_token_id)
+
+        yield {
+            "token_ids": next_tokens,
+            "logprobs": logprobs.gather(1, next_tokens.unsqueeze(1)).squeeze(1),
+            "output": output,
+        }
+        finished |= next_tokens == eos_token_id
+        if finished.all():
+            return
+
+        attention_mask = torch.cat([attention_mask, attention_mask.new_ones((num_streams, 1))], dim=1)
+        output = model.language_model(
+            input_ids=next_tokens.unsqueeze(1),
+            attention_mask=attention_mask,
+            past_key_values=past_key_values,
+            use_cache=True,
+            output_hidden_states=output_hidden_states,
+        )
+        past_key_values = output.past_key_values
+        logits = output.logits[:, -1].float()
+
+
+def sample_internvl_captions(
+    state,
+    img_path,
+    temperatures=1.0,
+    num_samples=1,
+    num_patches=1,
+    text_prompt=None,
+    max_new_tokens=512,
+    top_k=None,
+    image_encoder=None,
+):
+    """
+    Sample several captions for one image, running the vision tower and the prefill only once.
+
+    The KV cache of the prompt is forked into one decode stream per sample and all streams
+    are decoded together as a batch.
+
+    Args:
+        state: Dictionary containing model, model_name and tokenizer (from load_internvl_state).
+        img_path: Path to the image file (str).
+        temperatures: Sampling temperature or list of temperatures (default: 1.0). 0 means greedy decoding.
+        num_samples: Number of samples per temperature (default: 1).
+        num_patches: Number of image patches (default: 1).
+        text_prompt: Input text prompt (default: None, uses "Write a detailed description.").
+        max_new_tokens: Maximum number of generated tokens per sample (default: 512).
+        top_k: Optional top-k filtering applied before sampling (default: None).
+        image_encoder: Optional exported image encoder (from methods.vision_export.load_image_encoder).
+
+    Returns:
+        list: One dict per sample with keys
+            - temperature: Sampling temperature (float).
+            - caption: Decoded text output (str).
+            - token_ids: Generated token IDs without the stop token (list of int).
+            - token_logprobs: Log-probabilities of the generated tokens under the untempered model (list of float).
+    """
+    model = state["model"]
+    tokenizer = state["tokenizer"]
+
+    if not isinstance(temperatures, (list, tuple)):
+        temperatures = [temperatures]
+    stream_temperatures = [float(t) for t in temperatures for _ in range(num_samples)]
+
+    with torch.inference_mode():
+        # Префилл выполняется один раз для всех потоков
+        input_ids, attention_mask, output, eos_token_id, stop_str = prefill_internvl(
+            state, img_path, num_patches=num_patches, text_prompt=text_prompt, image_encoder=image_encoder
+        )
+        token_ids = []
+        token_logprobs = []
+        for step in decode_internvl(
+            model, output, attention_mask, eos_token_id, temperatures=stream_temperatures,
+            max_new_tokens=max_new_tokens, top_k=top_k
+        ):
+            token_ids.append(step["token_ids"])
+            token_logprobs.append(step["logprobs"])
+
+    token_ids = torch.stack(token_ids, dim=1).tolist()
+    token_logprobs = torch.stack(token_logprobs, dim=1).tolist()
+
+    samples = []
+    for temperature, ids, lps in zip(stream_temperatures, token_ids, token_logprobs):
+        length = ids.index(eos_token_id) if eos_token_id in ids else len(ids)
+        caption = tokenizer.decode(ids[:length], skip_special_tokens=True)
+        samples.append({
+            "temperature": temperature,
+            "caption": caption.split(stop_str)[0].strip(),
+            "token_ids": ids[:length],
+            "token_logprobs": lps[:length],
+        })
+    return samples
+
+
+def stream_caption_logit_lens_internvl(
+    state,
+    img_path,
+    num_patches=1,
+    text_prompt=None,
+    reduce="emitted",
+    top_k=5,
+    temperature=0.0,
+    max_new_tokens=512,
+    image_encoder=None,
+):
+    """
+    Generate a caption and yield the logit lens of every generated token as soon as it is decoded.
+
+    The hidden states of each new token are projected through lm_head and reduced immediately,
+    so memory does not grow with the caption length.
+
+    Args:
+        state: Dictionary containing model, model_name and tokenizer (from load_internvl_state).
+        img_path: Path to the image file (str).
+        num_patches: Number of image patches (default: 1).
+        text_prompt: Input text prompt (default: None, uses "Write a detailed description.").
+        reduce: Per-step reduction of the layer logits (default: "emitted"):
+            - "emitted": probability of the emitted token at every layer.
+            - "topk": top_k token IDs and probabilities at every layer.
+            - callable (layer_logits, token_id) -> result, layer_logits with shape (num_layers, vocab_size).
+        top_k: Number of tokens per layer for reduce="topk" (default: 5).
+        temperature: Sampling temperature, 0 means greedy decoding (default: 0.0).
+        max_new_tokens: Maximum number of generated tokens (default: 512).
+        image_encoder: Optional exported image encoder (from methods.vision_export.load_image_encoder).
+
+    Yields:
+        dict: Per generated token, with keys
+            - step: Index of the generated token (int).
+            - token_id: Generated token ID (int).
+            - token: Decoded token text (str).
+            - result: Output of the reduction (numpy array(s) or the callable's result).
+    """
+    model = state["model"]
+    tokenizer = state["tokenizer"]
+    lm_head = model.language_model.get_output_embeddings()
+
+    with torch.inference_mode():
+        input_ids, attention_mask, output, eos_token_id, stop_str = prefill_internvl(
+            state, img_path, num_patches=num_patches, text_prompt=text_prompt, output_hidden_states=True,
+            image_encoder=image_encoder
+        )
+
+        decode_steps = decode_internvl(
+            model, output, attention_mask, eos_token_id, temperatures=temperature,
+            max_new_tokens=max_new_tokens, output_hidden_states=True
+        )
+        for step, decoded in enumerate(decode_steps):
+            token_id = decoded["token_ids"].item()
+            if token_id == eos_token_id:
+                return
+
+            # Скрытые состояния позиции, предсказавшей токен: (num_layers, hidden_size)
+            hidden_states = torch.stack([hs[0, -1] for hs in decoded["output"].hidden_states])
+            layer_logits = lm_head(hidden_states).float()
+
+            if callable(reduce):
+                result = reduce(layer_logits, token_id)
+            elif reduce == "emitted":
+                result = torch.softmax(layer_logits, dim=-1)[:, token_id].cpu().numpy()
+            elif reduce == "topk":
+                probs, ids = torch.softmax(layer_logits, dim=-1).topk(top_k, dim=-1)
+                result = (ids.cpu().numpy(), probs.cpu().numpy())
+            else:
+                raise ValueError(f"Unknown reduce {reduce}, expected 'emitted', 'topk' or a callable.")
+
+            yield {
+                "step": step,
+                "token_id": token_id,
+                "token": tokenizer.decode([token_id]),
+                "result": result,
+            }
+
+
+def retrieve_logit_lens_internvl(
+    state,
+    img_path,
+    num_patches,
+    text_prompt=None,
+    temperature=1.0,
+    storage=None,
+    threshold=None,
+    tile_plan=None,
+    image_encoder=None,
+):
     """
     Retrieve caption and softmax probabilities for image tokens from InternVL2_5-1B.
 
@@ -257,11 +747,17 @@ def retrieve_logit_lens_internvl(state, img_path, num_patches, text_prompt=None,
         img_path: Path to the image file (str).
         text_prompt: Input text prompt (default: None, uses "Write a detailed description.").
         num_patches: Number of image patches (default: 1).
+        storage: Optional codec from methods.lens_codecs.CODECS to compress softmax_probs
+            (default: None, dense float32 numpy array).
+        threshold: Probabilities below this value are dropped and stored sparsely (requires storage).
+        tile_plan: Optional tile plan (from plan_image_tiles / plan_batch_tiles) overriding num_patches.
+        image_encoder: Optional exported image encoder (from methods.vision_export.load_image_encoder).
 
     Returns:
         tuple: (caption, softmax_probs)
             - caption: Decoded text output (str).
-            - softmax_probs: Softmax probabilities for image tokens, shape (vocab_size, num_layers, num_tokens).
+            - softmax_probs: Softmax probabilities for image tokens, shape (vocab_size, num_layers, num_tokens)
+              (EncodedLogitLens if storage is set).
     """
     model = state["model"]
     tokenizer = state["tokenizer"]
@@ -269,7 +765,7 @@ def retrieve_logit_lens_internvl(state, img_path, num_patches, text_prompt=None,
 
     
     pixel_values, images, image_sizes = generate_images_tensor(
-        state["model"], img_path, image_processor=image_processor, num_patches=num_patches
+        state["model"], img_path, image_processor=image_processor, num_patches=num_patches, tile_plan=tile_plan
     )
 
     # Генерация выходных данных модели с hidden_states=True
@@ -282,7 +778,8 @@ def retrieve_logit_lens_internvl(state, img_path, num_patches, text_prompt=None,
         text_prompt=text_prompt,
         hidden_states=True,
         num_patches=num_patches,
-        temperature=temperature
+        temperature=temperature,
+        image_encoder=image_encoder
     )
 
     # Декодирование выходных последовательностей
@@ -297,8 +794,8 @@ def retrieve_logit_lens_internvl(state, img_path, num_patches, text_prompt=None,
     except ValueError:
         raise ValueError(f"Token {IMG_CONTEXT_TOKEN} not found in input_ids.")
 
-    # Вычисляем количество токенов изображения
-    num_image_tokens = model.num_image_token * num_patches
+    # Вычисляем количество токенов изображения по фактическому числу тайлов
+    num_image_tokens = model.num_image_token * pixel_values.shape[0]
 
     # Проверяем, что все токены изображения присутствуют
     image_token_indices = (input_ids[0] == img_context_token_id).nonzero(as_tuple=True)[0]
@@ -325,9 +822,65 @@ def retrieve_logit_lens_internvl(state, img_path, num_patches, text_prompt=None,
 
     # maximum over all beams
     softmax_probs = softmax_probs.max(axis=3)
+
+    if storage is not None:
+        softmax_probs = encode_logit_lens(softmax_probs, codec=storage, threshold=threshold)
+    elif threshold is not None:
+        raise ValueError("threshold requires a storage codec.")
     return caption, softmax_probs
 
 
+def retrieve_logit_lens_topk_internvl(
+    state,
+    img_path,
+    index,
+    k=10,
+    n_probe=8,
+    num_patches=1,
+    text_prompt=None,
+    tile_plan=None,
+    image_encoder=None,
+):
+    """
+    Retrieve the top-k logit lens tokens of every image token and layer through an lm_head token index.
+
+    Opt-in alternative to retrieve_logit_lens_internvl when only the best tokens per patch are
+    needed: only the prompt is prefilled (no caption is generated) and the full vocabulary
+    projection is replaced by LmHeadTokenIndex.search, which rescores the probed lists exactly.
+
+    Args:
+        state: Dictionary containing model, model_name and tokenizer (from load_internvl_state).
+        img_path: Path to the image file (str).
+        index: LmHeadTokenIndex of the model (from methods.token_index.load_token_index_internvl).
+        k: Number of tokens per image token and layer (default: 10).
+        n_probe: Number of probed lists of the index (default: 8).
+        num_patches: Number of image patches (default: 1).
+        text_prompt: Input text prompt (default: None, uses "Write a detailed description.").
+        tile_plan: Optional tile plan (from plan_image_tiles / plan_batch_tiles) overriding num_patches.
+        image_encoder: Optional exported image encoder (from methods.vision_export.load_image_encoder).
+
+    Returns:
+        tuple: (token_ids, logits), numpy arrays with shape (num_layers, num_image_tokens, k). Logits
+            are unnormalised; missing candidates have token id -1 (see LmHeadTokenIndex.search).
+    """
+    tokenizer = state["tokenizer"]
+
+    with torch.inference_mode():
+        input_ids, _, output, _, _ = prefill_internvl(
+            state, img_path, num_patches=num_patches, text_prompt=text_prompt, output_hidden_states=True,
+            tile_plan=tile_plan, image_encoder=image_encoder
+        )
+        img_context_token_id = tokenizer.convert_tokens_to_ids(IMG_CONTEXT_TOKEN)
+        image_positions = (input_ids[0] == img_context_token_id).nonzero(as_tuple=True)[0]
+        if len(image_positions) == 0:
+            raise ValueError(f"Token {IMG_CONTEXT_TOKEN} not found in input_ids.")
+
+        # (num_layers, num_image_tokens, hidden_size)
+        image_hidden_states = torch.stack([hs[0, image_positions] for hs in output.hidden_states])
+        token_ids, logits = index.search(image_hidden_states, k=k, n_probe=n_probe)
+    return token_ids.cpu().numpy(), logits.cpu().numpy()
+
+
 def reshape_internvl_prompt_hidden_layers(hidden_states):
     """
     Reshape hidden states of the prompt for InternVL2_5-1B to (num_layers, num_prompt_tokens, hidden_size).
@@ -415,7 +968,7 @@ def get_hidden_text_embedding_internvl(
 
 
 def get_caption_from_internvl(
-    img_path, model, model_name, tokenizer, image_processor=None, text_prompt=None, num_patches=1
+    img_path, model, model_name, tokenizer, image_processor=None, text_prompt=None, num_patches=1, image_encoder=None
 ):
     """
     Generate a caption for an image using InternVL2_5-1B.
@@ -428,13 +981,14 @@ def get_caption_from_internvl(
         image_processor: Optional image processor (not used, kept for compatibility).
         text_prompt: Optional input text prompt (default: None, uses "Write a detailed description.").
         num_patches: Number of image patches (default: 1).
+        image_encoder: Optional exported image encoder (from methods.vision_export.load_image_encoder).
 
     Returns:
         str: Generated caption for the image.
     """
     # Подготовка изображений
     pixel_values, images, image_sizes = generate_images_tensor(
-        model, img_path, image_processor=None
+        model, img_path, image_processor=None, num_patches=num_patches
     )
 
     # Генерация подписи
@@ -446,18 +1000,22 @@ def get_caption_from_internvl(
         tokenizer,
         text_prompt=text_prompt,
         hidden_states=False,
-        num_patches=num_patches
+        num_patches=num_patches,
+        image_encoder=image_encoder
     )
 
     return new_caption
 
 
-def load_internvl_state(device="cuda", model_name=None):
+def load_internvl_state(device="cuda", model_name=None, torch_dtype=torch.float16, load_in_4bit=True):
     """
     Load the state for InternVL2_5-1B model, including model, tokenizer, and helper functions.
 
     Args:
         device: The device to place the model and tensors on (default: "cuda").
+        model_name: Name of the model (default: "OpenGVLab/InternVL2_5-1B").
+        torch_dtype: Dtype of the model weights (default: torch.float16; use torch.float32/bfloat16 on CPU).
+        load_in_4bit: Whether to quantize the model with bitsandbytes (default: True; GPU only).
 
     Returns:
         dict: State containing model, tokenizer, vocabulary, embeddings, and helper functions.
@@ -474,10 +1032,10 @@ def load_internvl_state(device="cuda", model_name=None):
     
     model = AutoModel.from_pretrained(
         model_name,
-        torch_dtype=torch.float16,
+        torch_dtype=torch_dtype,
         low_cpu_mem_usage=True,
         trust_remote_code=True,
-        load_in_4bit=True,
+        load_in_4bit=load_in_4bit,
         config=config
     ).eval().to(device)
 
@@ -488,8 +1046,9 @@ def load_internvl_state(device="cuda", model_name=None):
     vocab_embeddings = get_vocab_embeddings_internvl(model, tokenizer, device=device)
 
     # Вспомогательные функции
-    execute_model = lambda img_path, text_prompt=None, image_embeddings=None: get_caption_from_internvl(
-        img_path, model, model_name, tokenizer, image_processor=None, text_prompt=text_prompt, num_patches=1
+    execute_model = lambda img_path, text_prompt=None, image_embeddings=None, image_encoder=None: get_caption_from_internvl(
+        img_path, model, model_name, tokenizer, image_processor=None, text_prompt=text_prompt, num_patches=1,
+        image_encoder=image_encoder
     )
     register_hook = (
         lambda hook, layer: model.language_model.model.layers[layer].register_forward_hook(hook)
@@ -0,0 +1,256 @@
+import math
+
+import numpy as np
+
+
+# Поддерживаемые кодеки хранения вероятностей logit lens
+CODECS = ("float32", "float16", "bfloat16", "log_uint8", "log_uint16")
+
+# Диапазон (в натуральных логарифмах) ниже максимума по (layer, token), который сохраняют лог-кодеки
+DEFAULT_LOG_RANGE = {"log_uint8": math.log(1e8), "log_uint16": math.log(1e12)}
+
+# Число строк словаря, кодируемых за раз лог-кодеками (ограничивает временную память float64)
+_ENCODE_CHUNK_ROWS = 4096
+
+
+def codec_error_bound(codec, log_range=None):
+    """
+    Worst-case reconstruction error of a codec for probabilities in [0, 1].
+
+    Every codec guarantees |p - p_hat| <= max(rel * p, abs_) for each stored value
+    (before sparse thresholding, which additionally zeroes every value below the threshold):
+        - float32: exact.
+        - float16: rel = 2**-11 for p >= 2**-14, abs_ = 2**-25 (subnormal spacing / 2).
+        - bfloat16: rel = 2**-8 for p >= 2**-126, abs_ = 2**-134 (same exponent range as float32).
+        - log_uint8 / log_uint16: rel = (1 + exp(step / 2) - 1) * (1 + 2**-24) - 1 with
+          step = log_range / (2**bits - 2), i.e. the quantisation error plus the final rounding of the
+          decoded value to float32; abs_ = exp(-log_range) relative to the max of the (layer, token)
+          column, because smaller values are flushed to zero.
+
+    Args:
+        codec: Codec name, one of CODECS.
+        log_range: Dynamic range of the log codecs in nats (default: DEFAULT_LOG_RANGE[codec]).
+
+    Returns:
+        tuple: (rel, abs_) error bound.
+    """
+    if codec == "float32":
+        return 0.0, 0.0
+    if codec == "float16":
+        return 2.0 ** -11, 2.0 ** -25
+    if codec == "bfloat16":
+        return 2.0 ** -8, 2.0 ** -134
+    if codec in DEFAULT_LOG_RANGE:
+        if log_range is None:
+            log_range = DEFAULT_LOG_RANGE[codec]
+        levels = 2 ** (8 if codec == "log_uint8" else 16) - 2
+        quantisation = math.expm1(log_range / levels / 2)
+        # Декодированное значение округляется до float32: ещё до 2**-24 относительной ошибки
+        return (1 + quantisation) * (1 + 2.0 ** -24) - 1, math.exp(-log_range)
+    raise ValueError(f"Unknown codec {codec}, expected one of {CODECS}.")
+
+
+def _float32_to_bfloat16_bits(values):
+    bits = np.ascontiguousarray(values, dtype=np.float32).view(np.uint32)
+    # Округление к ближайшему чётному при отбрасывании младших 16 бит
+    rounding = ((bits >> 16) & 1) + np.uint32(0x7FFF)
+    return ((bits + rounding) >> 16).astype(np.uint16)
+
+
+def _bfloat16_bits_to_float32(bits):
+    return (bits.astype(np.uint32) << 16).view(np.float32)
+
+
+class EncodedLogitLens:
+    """
+    Compressed logit lens probabilities with shape (vocab_size, num_layers, num_tokens).
+
+    Indexing along the vocabulary axis (e.g. encoded[class_token_indices]) decodes only the
+    requested rows to float32, so the functions in methods/algorithms.py accept it in place of
+    the dense numpy array.
+    """
+
+    def __init__(self, codec, shape, values, scale=None, indices=None, threshold=None, log_range=None):
+        self.codec = codec
+        self.shape = tuple(shape)
+        self.values = values
+        # (offset, step) для лог-кодеков, shape (2, num_layers, num_tokens)
+        self.scale = scale
+        # Плоские отсортированные индексы ненулевых элементов при разреженном хранении
+        self.indices = indices
+        self.threshold = threshold
+        self.log_range = log_range
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.values, self.scale, self.indices) if a is not None)
+
+    @property
+    def error_bound(self):
+        return codec_error_bound(self.codec, self.log_range)
+
+    def _decode_values(self, values, layer_token_index=None):
+        if self.codec == "float32":
+            return values.astype(np.float32, copy=False)
+        if self.codec == "float16":
+            return values.astype(np.float32)
+        if self.codec == "bfloat16":
+            return _bfloat16_bits_to_float32(values)
+
+        offset, step = self.scale[0], self.scale[1]
+        if layer_token_index is not None:
+            offset, step = offset.reshape(-1)[layer_token_index], step.reshape(-1)[layer_token_index]
+        decoded = np.exp(offset.astype(np.float64) + (values.astype(np.float64) - 1) * step)
+        # Код 0 зарезервирован под нули
+        return np.where(values == 0, np.float32(0), decoded).astype(np.float32)
+
+    def _decode_rows(self, rows):
+        rows = np.atleast_1d(np.asarray(rows, dtype=np.int64))
+        rows = np.where(rows < 0, rows + self.shape[0], rows)
+        if self.indices is None:
+            return self._decode_values(self.values[rows])
+
+        row_size = self.shape[1] * self.shape[2]
+        out = np.zeros((len(rows),) + self.shape[1:], dtype=np.float32)
+        flat_out = out.reshape(len(rows), row_size)
+        starts = np.searchsorted(self.indices, rows * row_size, side="left")
+        ends = np.searchsorted(self.indices, (rows + 1) * row_size, side="left")
+        for i, (start, end) in enumerate(zip(starts, ends)):
+            if start == end:
+                continue
+            within_row = (self.indices[start:end] % row_size).astype(np.int64)
+            flat_out[i, within_row] = self._decode_values(self.values[start:end], within_row)
+        return out
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            rows, rest = key[0], key[1:]
+        else:
+            rows, rest = key, ()
+
+        scalar = not isinstance(rows, slice) and np.ndim(rows) == 0
+        if isinstance(rows, slice):
+            decoded = self._decode_rows(np.arange(self.shape[0])[rows])
+        elif scalar:
+            decoded = self._decode_rows([rows])[0]
+        else:
+            decoded = self._decode_rows(rows)
+
+        if not rest:
+            return decoded
+        # Для скалярного индекса ось словаря уже снята
+        return decoded[rest] if scalar else decoded[(slice(None),) + rest]
+
+    def decode(self):
+        """Decode the full array to float32 numpy (vocab_size, num_layers, num_tokens)."""
+        return self[:]
+
+    def save(self, path):
+        arrays = {"values": self.values}
+        if self.scale is not None:
+            arrays["scale"] = self.scale
+        if self.indices is not None:
+            arrays["indices"] = self.indices
+        np.savez(
+            path,
+            codec=np.array(self.codec),
+            shape=np.array(self.shape, dtype=np.int64),
+            threshold=np.array(np.nan if self.threshold is None else self.threshold),
+            log_range=np.array(np.nan if self.log_range is None else self.log_range),
+            **arrays,
+        )
+
+
+def load_logit_lens(path):
+    """
+    Load logit lens probabilities saved with EncodedLogitLens.save.
+
+    Args:
+        path: Path to the .npz file (str).
+
+    Returns:
+        EncodedLogitLens: The encoded probabilities.
+    """
+    with np.load(path) as data:
+        threshold = float(data["threshold"])
+        log_range = float(data["log_range"])
+        return EncodedLogitLens(
+            str(data["codec"]),
+            tuple(int(n) for n in data["shape"]),
+            data["values"],
+            scale=data["scale"] if "scale" in data else None,
+            indices=data["indices"] if "indices" in data else None,
+            threshold=None if math.isnan(threshold) else threshold,
+            log_range=None if math.isnan(log_range) else log_range,
+        )
+
+
+def encode_logit_lens(softmax_probs, codec="float16", threshold=None, log_range=None):
+    """
+    Encode logit lens probabilities into a compact low-precision representation.
+
+    Args:
+        softmax_probs: Probabilities with shape (vocab_size, num_layers, num_tokens)
+            (from retrieve_logit_lens_internvl).
+        codec: One of CODECS (default: "float16"). See codec_error_bound for the error of each codec.
+        threshold: If set, probabilities below this value are dropped and the rest is stored
+            sparsely (default: None, dense storage).
+        log_range: Dynamic range of the log codecs in nats (default: DEFAULT_LOG_RANGE[codec]).
+
+    Returns:
+        EncodedLogitLens: The encoded probabilities.
+    """
+    if codec not in CODECS:
+        raise ValueError(f"Unknown codec {codec}, expected one of {CODECS}.")
+    softmax_probs = np.asarray(softmax_probs, dtype=np.float32)
+    if softmax_probs.ndim != 3:
+        raise ValueError(f"Expected softmax_probs with 3 dimensions, got shape {softmax_probs.shape}")
+    shape = softmax_probs.shape
+
+    scale = None
+    if codec in DEFAULT_LOG_RANGE:
+        if log_range is None:
+            log_range = DEFAULT_LOG_RANGE[codec]
+        dtype = np.uint8 if codec == "log_uint8" else np.uint16
+        levels = np.iinfo(dtype).max - 1
+
+        # Масштаб на каждую пару (layer, token): лог-диапазон [max - log_range, max]
+        with np.errstate(divide="ignore"):
+            top = np.log(softmax_probs.max(axis=0))
+            positive_min = np.where(softmax_probs > 0, softmax_probs, np.inf).min(axis=0)
+            offset = np.maximum(np.log(positive_min), top - log_range)
+        offset = np.where(np.isfinite(offset), offset, 0).astype(np.float32)
+        step = np.where(np.isfinite(top), (top - offset) / levels, 0).astype(np.float32)
+        step = np.where(step > 0, step, np.float32(1.0)).astype(np.float32)
+        scale = np.stack([offset, step])
+
+        # Всё, что ниже нижней границы диапазона, кодируется нулём
+        values = np.empty(shape, dtype=dtype)
+        lower = np.exp(offset.astype(np.float64) - step / 2)
+        for start in range(0, shape[0], _ENCODE_CHUNK_ROWS):
+            chunk = softmax_probs[start:start + _ENCODE_CHUNK_ROWS]
+            # Логарифм в float64, чтобы ошибка округления не добавлялась к шагу квантования
+            with np.errstate(divide="ignore"):
+                codes = np.rint((np.log(chunk.astype(np.float64)) - offset) / step) + 1
+            values[start:start + _ENCODE_CHUNK_ROWS] = np.where(chunk >= lower, np.clip(codes, 1, levels + 1), 0)
+    elif codec == "float16":
+        values = softmax_probs.astype(np.float16)
+    elif codec == "bfloat16":
+        values = _float32_to_bfloat16_bits(softmax_probs)
+    else:
+        values = softmax_probs
+
+    indices = None
+    if threshold is not None:
+        flat_mask = (softmax_probs >= threshold).reshape(-1)
+        index_dtype = np.uint32 if flat_mask.size <= np.iinfo(np.uint32).max else np.int64
+        indices = np.flatnonzero(flat_mask).astype(index_dtype)
+        values = values.reshape(-1)[indices]
+
+    return EncodedLogitLens(
+        codec, shape, values, scale=scale, indices=indices, threshold=threshold, log_range=log_range
+    )
@@ -0,0 +1,187 @@
+import os
+
+import torch
+
+
+class LmHeadTokenIndex:
+    """
+    Inverted-list index over the lm_head rows for approximate top-k logit lens decoding.
+
+    Logit lens decoding is a maximum inner product search, so every row w is first mapped to the
+    unit vector [w, sqrt(M**2 - |w|**2)] / M (M is the largest row norm) and the augmented rows are
+    clustered with spherical k-means. For a query q the inner product with an augmented row is
+    q . w / M, so scoring the centroids with [q, 0] ranks the lists by the same inner product as
+    the logits. The n_probe best lists are rescored exactly with the original lm_head weights.
+    Recall is tuned with n_probe, the returned logits are exact.
+    """
+
+    def __init__(self, weight, centroids, row_ids, offsets):
+        """
+        Args:
+            weight: lm_head weight, shape (vocab_size, hidden_size).
+            centroids: Cluster centroids of the augmented rows, shape (num_lists, hidden_size + 1).
+            row_ids: Vocabulary rows sorted by cluster, shape (vocab_size,).
+            offsets: Start of every cluster in row_ids, shape (num_lists + 1,).
+        """
+        self.weight = weight.detach()
+        self.centroids = centroids.to(weight.device, dtype=torch.float32)
+        self.row_ids = row_ids.to(weight.device)
+        self.offsets = offsets.tolist()
+        # Строки словаря, переупорядоченные по кластерам, чтобы каждый список был непрерывным блоком
+        self.sorted_weight = self.weight[self.row_ids]
+
+    @property
+    def num_lists(self):
+        return self.centroids.shape[0]
+
+    @classmethod
+    def build(cls, weight, num_lists=None, num_iters=10, seed=0):
+        """
+        Cluster the lm_head rows into inverted lists.
+
+        Args:
+            weight: lm_head weight, shape (vocab_size, hidden_size) (e.g. model.language_model.lm_head.weight).
+            num_lists: Number of clusters (default: 4 * sqrt(vocab_size)).
+            num_iters: Number of k-means iterations (default: 10).
+            seed: Random seed of the initial centroids (default: 0).
+
+        Returns:
+            LmHeadTokenIndex: The built index.
+        """
+        weight = weight.detach()
+        vocab_size = weight.shape[0]
+        if num_lists is None:
+            num_lists = int(4 * vocab_size ** 0.5)
+
+        with torch.inference_mode():
+            # Сведение MIPS к косинусной близости: добавочная координата выравнивает нормы строк
+            rows = weight.float()
+            norms = rows.norm(dim=-1, keepdim=True)
+            max_norm = norms.max()
+            extra = (max_norm ** 2 - norms ** 2).clamp_min(0).sqrt()
+            rows = torch.cat([rows, extra], dim=-1) / max_norm
+            generator = torch.Generator(device="cpu").manual_seed(seed)
+            centroids = rows[torch.randperm(vocab_size, generator=generator)[:num_lists].to(rows.device)]
+
+            for _ in range(num_iters):
+                assignment = cls._assign(rows, centroids)
+                sums = torch.zeros_like(centroids).index_add_(0, assignment, rows)
+                counts = torch.bincount(assignment, minlength=num_lists)
+                # Пустые кластеры сохраняют прежний центроид
+                centroids = torch.where(
+                    counts[:, None] > 0, torch.nn.functional.normalize(sums, dim=-1), centroids
+                )
+
+            assignment = cls._assign(rows, centroids)
+            row_ids = torch.argsort(assignment, stable=True)
+            counts = torch.bincount(assignment, minlength=num_lists)
+            offsets = torch.cat([counts.new_zeros(1), counts.cumsum(0)])
+        return cls(weight, centroids, row_ids, offsets)
+
+    @staticmethod
+    def _assign(rows, centroids, chunk_size=16384):
+        return torch.cat([
+            (rows[i:i + chunk_size] @ centroids.T).argmax(dim=-1)
+            for i in range(0, rows.shape[0], chunk_size)
+        ])
+
+    def save(self, path):
+        torch.save(
+            {
+                "centroids": self.centroids.cpu(),
+                "row_ids": self.row_ids.cpu(),
+                "offsets": torch.tensor(self.offsets),
+                "shape": tuple(self.weight.shape),
+            },
+            path,
+        )
+
+    @classmethod
+    def load(cls, path, weight):
+        data = torch.load(path, map_location="cpu")
+        if tuple(data["shape"]) != tuple(weight.shape):
+            raise ValueError(f"Index was built for lm_head {data['shape']}, got {tuple(weight.shape)}.")
+        if data["centroids"].shape[1] != weight.shape[1] + 1:
+            raise ValueError(f"Index at {path} has no norm-augmented centroids, rebuild it with LmHeadTokenIndex.build.")
+        return cls(weight, data["centroids"], data["row_ids"], data["offsets"])
+
+    def search(self, hidden_states, k=10, n_probe=8):
+        """
+        Approximate top-k tokens for a batch of hidden states.
+
+        Args:
+            hidden_states: Tensor with shape (..., hidden_size), e.g. (num_layers, num_tokens, hidden_size).
+            k: Number of tokens per hidden state (default: 10).
+            n_probe: Number of probed lists, higher means better recall (default: 8).
+
+        Returns:
+            tuple: (token_ids, logits), each with shape (..., k), logits computed exactly. If the probed
+                lists hold fewer than k rows, the missing positions have token id -1 and logit -inf.
+        """
+        batch_shape = hidden_states.shape[:-1]
+        queries = hidden_states.reshape(-1, hidden_states.shape[-1]).to(self.weight.device, dtype=self.weight.dtype)
+        n_probe = min(n_probe, self.num_lists)
+
+        with torch.inference_mode():
+            # Запрос дополняется нулём, поэтому последняя координата центроидов не участвует
+            probes = (queries.float() @ self.centroids[:, :-1].T).topk(n_probe, dim=-1).indices
+            values = queries.new_full((queries.shape[0], n_probe, k), float("-inf"), dtype=torch.float32)
+            ids = torch.full((queries.shape[0], n_probe, k), -1, dtype=torch.long, device=queries.device)
+
+            # Каждый список пересчитывается одним умножением для всех запросов, которые его выбрали
+            for list_id in probes.unique().tolist():
+                start, end = self.offsets[list_id], self.offsets[list_id + 1]
+                if start == end:
+                    continue
+                query_index, probe_slot = (probes == list_id).nonzero(as_tuple=True)
+                logits = (queries[query_index] @ self.sorted_weight[start:end].T).float()
+                top = logits.topk(min(k, end - start), dim=-1)
+                values[query_index, probe_slot, :top.values.shape[1]] = top.values
+                ids[query_index, probe_slot, :top.values.shape[1]] = self.row_ids[start + top.indices]
+
+            values = values.reshape(queries.shape[0], -1)
+            top = values.topk(min(k, values.shape[1]), dim=-1)
+            token_ids = ids.reshape(queries.shape[0], -1).gather(1, top.indices)
+        return token_ids.reshape(*batch_shape, -1), top.values.reshape(*batch_shape, -1)
+
+    def recall(self, hidden_states, k=10, n_probe=8):
+        """
+        Fraction of the exact top-k tokens found by search, to tune n_probe.
+
+        Args:
+            hidden_states: Tensor with shape (..., hidden_size).
+            k: Number of tokens per hidden state (default: 10).
+            n_probe: Number of probed lists (default: 8).
+
+        Returns:
+            float: Recall@k averaged over the hidden states.
+        """
+        queries = hidden_states.reshape(-1, hidden_states.shape[-1]).to(self.weight.device, dtype=self.weight.dtype)
+        with torch.inference_mode():
+            exact = (queries @ self.weight.T).topk(k, dim=-1).indices
+        approx, _ = self.search(queries, k=k, n_probe=n_probe)
+        hits = (exact[:, :, None] == approx[:, None, :]).any(dim=-1)
+        return hits.float().mean().item()
+
+
+def load_token_index_internvl(state, path=None, **build_kwargs):
+    """
+    Load the lm_head token index of a model, building and persisting it on first use.
+
+    Args:
+        state: Dictionary returned by load_internvl_state.
+        path: Index file path (default: None, derived from the model name in the current directory).
+        **build_kwargs: Arguments of LmHeadTokenIndex.build.
+
+    Returns:
+        LmHeadTokenIndex: The index.
+    """
+    weight = state["model"].language_model.get_output_embeddings().weight
+    if path is None:
+        path = state["model_name"].replace("/", "__") + ".lm_head_index.pt"
+
+    if os.path.exists(path):
+        return LmHeadTokenIndex.load(path, weight)
+    index = LmHeadTokenIndex.build(weight, **build_kwargs)
+    index.save(path)
+    return index
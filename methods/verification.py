@@ -0,0 +1,195 @@
+import re
+
+import torch
+
+from methods.class_tokens import class_probs
+from methods.internvl_utils import IMG_CONTEXT_TOKEN, prefill_internvl, decode_internvl
+
+
+# Классы COCO и их распространённые синонимы в подписях: слово -> класс
+COCO_OBJECT_LEXICON = {
+    **{name: name for name in (
+        "person", "bicycle", "car", "motorcycle", "airplane", "bus", "train", "truck", "boat",
+        "traffic light", "fire hydrant", "stop sign", "parking meter", "bench", "bird", "cat", "dog",
+        "horse", "sheep", "cow", "elephant", "bear", "zebra", "giraffe", "backpack", "umbrella",
+        "handbag", "tie", "suitcase", "frisbee", "skis", "snowboard", "sports ball", "kite",
+        "baseball bat", "baseball glove", "skateboard", "surfboard", "tennis racket", "bottle",
+        "wine glass", "cup", "fork", "knife", "spoon", "bowl", "banana", "apple", "sandwich", "orange",
+        "broccoli", "carrot", "hot dog", "pizza", "donut", "cake", "chair", "couch", "potted plant",
+        "bed", "dining table", "toilet", "tv", "laptop", "mouse", "remote", "keyboard", "cell phone",
+        "microwave", "oven", "toaster", "sink", "refrigerator", "book", "clock", "vase", "scissors",
+        "teddy bear", "hair drier", "toothbrush",
+    )},
+    "man": "person", "woman": "person", "people": "person", "men": "person", "women": "person",
+    "child": "person", "children": "person", "boy": "person", "girl": "person", "player": "person",
+    "bike": "bicycle", "motorbike": "motorcycle", "plane": "airplane", "jet": "airplane",
+    "ship": "boat", "puppy": "dog", "kitten": "cat", "bag": "handbag", "purse": "handbag",
+    "ball": "sports ball", "racket": "tennis racket", "glass": "wine glass", "mug": "cup",
+    "doughnut": "donut", "sofa": "couch", "plant": "potted plant", "table": "dining table",
+    "television": "tv", "computer": "laptop", "phone": "cell phone", "fridge": "refrigerator",
+    "teddy": "teddy bear",
+}
+
+# Формы, которые не приводятся к единственному числу общими правилами
+_IRREGULAR_SINGULARS = {
+    "people": "people", "men": "men", "women": "women", "children": "children", "skis": "skis",
+    "scissors": "scissors", "sports": "sports", "tennis": "tennis", "buses": "bus", "knives": "knife",
+    "mice": "mouse", "glasses": "glass",
+}
+
+
+def _singularize(word):
+    if word in _IRREGULAR_SINGULARS:
+        return _IRREGULAR_SINGULARS[word]
+    if word.endswith("ies") and len(word) > 4:
+        return word[:-3] + "y"
+    if word.endswith(("ches", "shes", "sses", "xes")):
+        return word[:-2]
+    if word.endswith("s") and not word.endswith("ss") and len(word) > 3:
+        return word[:-1]
+    return word
+
+
+def extract_caption_objects(caption, lexicon=None):
+    """
+    Find object words of a caption with a rule-based lexicon matcher.
+
+    Multi-word entries (e.g. "traffic light") are matched before single words, and plural
+    forms are reduced to the singular.
+
+    Args:
+        caption: Generated caption (str).
+        lexicon: Mapping from surface word to object class (default: COCO_OBJECT_LEXICON).
+
+    Returns:
+        list: Unique (word, class) pairs in order of appearance.
+    """
+    if lexicon is None:
+        lexicon = COCO_OBJECT_LEXICON
+    max_words = max(len(key.split()) for key in lexicon)
+    words = [_singularize(w) for w in re.findall(r"[a-z]+", caption.lower())]
+
+    objects = []
+    seen = set()
+    i = 0
+    while i < len(words):
+        for n in range(min(max_words, len(words) - i), 0, -1):
+            phrase = " ".join(words[i:i + n])
+            if phrase in lexicon:
+                if phrase not in seen:
+                    seen.add(phrase)
+                    objects.append((phrase, lexicon[phrase]))
+                i += n
+                break
+        else:
+            i += 1
+    return objects
+
+
+class _ImageTokenLogitLens:
+    """
+    Lazy logit lens of image-token hidden states, shape (vocab_size, num_layers, num_tokens).
+
+    Indexing along the vocabulary axis (e.g. lens[token_ids]) projects the hidden states through
+    lm_head layer_chunk layers at a time, normalises over the full vocabulary and keeps only the
+    requested rows, so it can be passed to class_probs without materialising softmax_probs.
+    """
+
+    def __init__(self, lm_head, hidden_states, layer_chunk=4):
+        self.lm_head = lm_head
+        # (num_layers, num_tokens, hidden_size)
+        self.hidden_states = hidden_states
+        self.layer_chunk = layer_chunk
+        self.shape = (lm_head.weight.shape[0],) + tuple(hidden_states.shape[:2])
+
+    def __getitem__(self, rows):
+        token_ids = torch.as_tensor(rows, dtype=torch.long, device=self.hidden_states.device)
+        chunks = []
+        for start in range(0, self.hidden_states.shape[0], self.layer_chunk):
+            logits = self.lm_head(self.hidden_states[start:start + self.layer_chunk]).float()
+            chunks.append(torch.exp(logits[..., token_ids] - torch.logsumexp(logits, dim=-1, keepdim=True)))
+        # (num_rows, num_layers, num_tokens)
+        return torch.cat(chunks).permute(2, 0, 1).cpu().numpy()
+
+
+def verify_caption_internvl(
+    state,
+    img_path,
+    num_patches=1,
+    text_prompt=None,
+    lexicon=None,
+    threshold=0.1,
+    max_new_tokens=512,
+    image_encoder=None,
+    variants=("plain",),
+    aggregation="max",
+    layer_chunk=4,
+):
+    """
+    Generate a caption and score its object words against the image-token logit lens in one model pass.
+
+    The prompt prefill provides the image-token hidden states of every layer, the caption is
+    decoded greedily from the same KV cache, and the internal confidence of all extracted words
+    is gathered at once with class_probs without materialising the full softmax_probs array.
+
+    Args:
+        state: Dictionary containing model, model_name and tokenizer (from load_internvl_state).
+        img_path: Path to the image file (str).
+        num_patches: Number of image patches (default: 1).
+        text_prompt: Input text prompt (default: None, uses "Write a detailed description.").
+        lexicon: Mapping from surface word to object class (default: COCO_OBJECT_LEXICON).
+        threshold: Internal confidence below which an object is flagged as hallucinated (default: 0.1).
+        max_new_tokens: Maximum number of generated tokens (default: 512).
+        image_encoder: Optional exported image encoder (from methods.vision_export.load_image_encoder).
+        variants: Spelling variants of the object words (see methods.class_tokens.VARIANTS).
+        aggregation: How subword tokens of multi-token words are combined (default: "max").
+        layer_chunk: Number of layers projected through lm_head at once; memory grows with
+            layer_chunk * num_image_tokens * vocab_size (default: 4).
+
+    Returns:
+        dict: With keys
+            - caption: Generated caption (str).
+            - objects: List of dicts with word, class, confidence (float) and hallucinated (bool).
+    """
+    model = state["model"]
+    tokenizer = state["tokenizer"]
+    lm_head = model.language_model.get_output_embeddings()
+
+    with torch.inference_mode():
+        input_ids, attention_mask, output, eos_token_id, stop_str = prefill_internvl(
+            state, img_path, num_patches=num_patches, text_prompt=text_prompt, output_hidden_states=True,
+            image_encoder=image_encoder
+        )
+        img_context_token_id = tokenizer.convert_tokens_to_ids(IMG_CONTEXT_TOKEN)
+        image_positions = (input_ids[0] == img_context_token_id).nonzero(as_tuple=True)[0]
+        # (num_layers, num_image_tokens, hidden_size)
+        image_hidden_states = torch.stack([hs[0, image_positions] for hs in output.hidden_states])
+
+        token_ids = [
+            step["token_ids"].item()
+            for step in decode_internvl(model, output, attention_mask, eos_token_id, max_new_tokens=max_new_tokens)
+        ]
+        token_ids = token_ids[:token_ids.index(eos_token_id)] if eos_token_id in token_ids else token_ids
+        caption = tokenizer.decode(token_ids, skip_special_tokens=True).split(stop_str)[0].strip()
+
+        objects = extract_caption_objects(caption, lexicon)
+        if not objects:
+            return {"caption": caption, "objects": []}
+
+        # Уверенность слова - максимум по слоям и токенам изображения, как в internal_confidence
+        lens = _ImageTokenLogitLens(lm_head, image_hidden_states, layer_chunk)
+        word_probs = class_probs(tokenizer, lens, [word for word, _ in objects], variants, aggregation)
+        word_confidence = word_probs.max(axis=(1, 2)).astype(float).tolist()
+
+    return {
+        "caption": caption,
+        "objects": [
+            {
+                "word": word,
+                "class": class_,
+                "confidence": confidence,
+                "hallucinated": confidence < threshold,
+            }
+            for (word, class_), confidence in zip(objects, word_confidence)
+        ],
+    }
@@ -0,0 +1,138 @@
+import torch
+
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
+
+
+class InternVLImageEncoder(torch.nn.Module):
+    """Image-encoding step of InternVL: pixel tiles -> projected <IMG_CONTEXT> embeddings."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        # vision tower + pixel shuffle + MLP-проектор, как в InternVLChatModel.extract_feature
+        return self.model.extract_feature(pixel_values)
+
+
+def export_image_encoder(model, path, format="torchscript", image_size=448, opset_version=17):
+    """
+    Export the vision tower and projector of InternVL for optimized CPU inference.
+
+    The model must be loaded without quantization (load_internvl_state(load_in_4bit=False)).
+    The tile size is fixed to image_size, the number of tiles stays dynamic.
+
+    Args:
+        model: The InternVLChatModel instance.
+        path: Output file path (str).
+        format: "torchscript" or "onnx" (default: "torchscript").
+        image_size: Tile size in pixels (default: 448).
+        opset_version: ONNX opset version (default: 17).
+
+    Returns:
+        str: Path of the exported encoder.
+    """
+    encoder = InternVLImageEncoder(model).eval()
+    parameter = next(model.vision_model.parameters())
+    example = torch.randn(1, 3, image_size, image_size, device=parameter.device, dtype=parameter.dtype)
+
+    with torch.no_grad():
+        if format == "torchscript":
+            traced = torch.jit.trace(encoder, example, check_trace=False)
+            traced = torch.jit.freeze(traced)
+            # После freeze параметры встроены в граф, поэтому dtype входа сохраняем рядом
+            traced.save(path, _extra_files={"input_dtype": str(example.dtype)})
+        elif format == "onnx":
+            torch.onnx.export(
+                encoder,
+                (example,),
+                path,
+                input_names=["pixel_values"],
+                output_names=["image_embeds"],
+                dynamic_axes={"pixel_values": {0: "num_tiles"}, "image_embeds": {0: "num_tiles"}},
+                opset_version=opset_version,
+            )
+        else:
+            raise ValueError(f"Unknown format {format}, expected 'torchscript' or 'onnx'.")
+    return path
+
+
+def load_image_encoder(path, num_threads=None):
+    """
+    Load an exported image encoder as a callable pixel_values -> image embeddings.
+
+    The result can be passed as image_encoder to run_internvl_model / retrieve_logit_lens_internvl.
+
+    Args:
+        path: Path of an encoder exported with export_image_encoder (str).
+        num_threads: Intra-op threads of the encoder (default: None, runtime default).
+
+    Returns:
+        callable: Function taking a pixel_values tensor and returning a torch.Tensor of embeddings.
+    """
+    if path.endswith(".onnx"):
+        if ort is None:
+            raise ImportError("ONNX encoders require onnxruntime: pip install onnxruntime")
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        session = ort.InferenceSession(path, sess_options=options, providers=["CPUExecutionProvider"])
+        input_type = session.get_inputs()[0].type
+
+        def encode(pixel_values):
+            dtype = torch.float16 if input_type == "tensor(float16)" else torch.float32
+            inputs = pixel_values.detach().to("cpu", dtype=dtype).numpy()
+            return torch.from_numpy(session.run(None, {"pixel_values": inputs})[0])
+
+        return encode
+
+    extra_files = {"input_dtype": ""}
+    module = torch.jit.load(path, map_location="cpu", _extra_files=extra_files)
+    input_dtype = extra_files["input_dtype"]
+    if isinstance(input_dtype, bytes):
+        input_dtype = input_dtype.decode()
+    input_dtype = getattr(torch, input_dtype.replace("torch.", "") or "float32")
+
+    def encode(pixel_values):
+        # Число потоков меняем только на время вызова энкодера, чтобы не перенастроить языковую модель
+        previous_threads = torch.get_num_threads()
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        try:
+            with torch.inference_mode():
+                return module(pixel_values.to("cpu", dtype=input_dtype))
+        finally:
+            torch.set_num_threads(previous_threads)
+
+    return encode
+
+
+def check_image_encoder(model, image_encoder, pixel_values, atol=1e-3, rtol=1e-3):
+    """
+    Compare an exported image encoder with the eager model on the same tiles.
+
+    Args:
+        model: The InternVLChatModel instance.
+        image_encoder: Callable returned by load_image_encoder.
+        pixel_values: Tensor of processed images (from generate_images_tensor).
+        atol: Absolute tolerance (default: 1e-3).
+        rtol: Relative tolerance (default: 1e-3).
+
+    Returns:
+        float: Maximum absolute difference between the two embeddings.
+    """
+    with torch.inference_mode():
+        expected = model.extract_feature(pixel_values).float().cpu()
+        actual = image_encoder(pixel_values).float().cpu()
+
+    if expected.shape != actual.shape:
+        raise ValueError(f"Encoder output shape {tuple(actual.shape)} != eager {tuple(expected.shape)}.")
+    max_diff = (expected - actual).abs().max().item()
+    if not torch.allclose(actual, expected, atol=atol, rtol=rtol):
+        raise ValueError(f"Exported encoder diverges from the eager model: max abs diff {max_diff}.")
+    return max_diff
@@ -0,0 +1,173 @@
+import os
+import queue
+import multiprocessing as mp
+
+import torch
+
+from methods.class_tokens import class_probs
+from methods.internvl_utils import retrieve_logit_lens_internvl
+
+
+# Состояние модели, унаследованное рабочими процессами при fork (copy-on-write)
+_SHARED_STATE = None
+_WORKER_FN = None
+
+# Каждый воркер держит полные логиты lm_head одного изображения (несколько ГБ), поэтому число
+# воркеров по умолчанию не зависит от числа ядер: ядра делятся между ними как intra-op потоки
+DEFAULT_NUM_WORKERS = 2
+
+
+def share_internvl_state(state):
+    """
+    Move the model weights and vocabulary embeddings of a loaded state into shared memory.
+
+    After this call the tensors live in shared memory segments, so forked workers map the same
+    physical pages instead of copying them on first write.
+
+    Args:
+        state: Dictionary returned by load_internvl_state (must be loaded on CPU).
+
+    Returns:
+        dict: The same state, with shared, read-only tensors.
+    """
+    model = state["model"]
+    if model.device.type != "cpu":
+        raise ValueError(f"Shared worker pool requires a CPU model, got device {model.device}.")
+
+    model.share_memory()
+    for param in model.parameters():
+        param.requires_grad_(False)
+
+    # vocab_embeddings посчитаны вне inference_mode и тянут за собой граф — отрезаем его
+    state["vocab_embeddings"] = state["vocab_embeddings"].detach().share_memory_()
+    return state
+
+
+def _init_worker(threads_per_worker, cpu_sets):
+    # Каждый процесс получает свою долю ядер и не конкурирует с соседями за потоки
+    torch.set_num_threads(threads_per_worker)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Пул inter-op потоков уже запущен (унаследован от родителя) — оставляем как есть
+        pass
+
+    if cpu_sets is not None and hasattr(os, "sched_setaffinity"):
+        # Каждый набор ядер выдаётся ровно одному воркеру; если пул заменил упавший воркер и
+        # свободных наборов не осталось, процесс работает без привязки, а не делит ядра с соседом
+        try:
+            os.sched_setaffinity(0, cpu_sets.get_nowait())
+        except queue.Empty:
+            pass
+
+
+def _run_worker(item):
+    index, img_path = item
+    with torch.inference_mode():
+        return index, _WORKER_FN(_SHARED_STATE, img_path)
+
+
+def _default_worker_fn(classes, num_patches, text_prompt):
+    # Полный softmax_probs (vocab x layers x tokens) не покидает воркер: возвращаем только свёртку по классам
+    def worker_fn(state, img_path):
+        caption, softmax_probs = retrieve_logit_lens_internvl(
+            state, img_path, num_patches=num_patches, text_prompt=text_prompt
+        )
+        confidence = class_probs(state["tokenizer"], softmax_probs, classes).max(axis=2)
+        return caption, confidence
+
+    return worker_fn
+
+
+def run_internvl_process_pool(
+    state,
+    img_paths,
+    worker_fn=None,
+    num_workers=None,
+    threads_per_worker=None,
+    pin_cores=True,
+    chunksize=1,
+    num_patches=1,
+    text_prompt=None,
+    classes=None,
+):
+    """
+    Process images with several CPU worker processes that share one copy of the model weights.
+
+    The weights are loaded once in the parent process, moved to shared memory and inherited by
+    the workers through fork, so RAM usage does not grow with the number of workers. Images are
+    sharded across workers and each worker is pinned to its own set of cores.
+
+    Args:
+        state: Dictionary returned by load_internvl_state(device="cpu", ...).
+        img_paths: List of image file paths (str).
+        worker_fn: Callable (state, img_path) -> result, executed in the workers. Results are pickled
+            back to the parent, so worker_fn should reduce them (default: retrieve_logit_lens_internvl
+            reduced to (caption, per-class per-layer confidence of shape (num_classes, num_layers));
+            requires classes).
+        num_workers: Number of worker processes (default: DEFAULT_NUM_WORKERS). Every worker holds the
+            activations of one image, so peak memory grows with num_workers, not with the core count.
+        threads_per_worker: Intra-op threads per worker (default: number of cores available to the
+            process, os.sched_getaffinity or os.cpu_count(), divided by num_workers).
+        pin_cores: Whether to pin each worker to a disjoint set of threads_per_worker cores (default: True,
+            Linux only). Requires threads_per_worker * num_workers available cores.
+        chunksize: Number of images sent to a worker at once (default: 1).
+        num_patches: Number of image patches for the default worker_fn (default: 1).
+        text_prompt: Input text prompt for the default worker_fn (default: None).
+        classes: Class words scored by the default worker_fn (default: None).
+
+    Returns:
+        list: Results of worker_fn, in the order of img_paths.
+    """
+    global _SHARED_STATE, _WORKER_FN
+
+    if "fork" not in mp.get_all_start_methods():
+        raise RuntimeError("Shared worker pool requires the 'fork' start method.")
+
+    if hasattr(os, "sched_getaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        cpus = list(range(os.cpu_count() or 1))
+
+    if worker_fn is None and classes is None:
+        raise ValueError("Pass classes for the default worker_fn or an explicit worker_fn.")
+
+    if num_workers is None:
+        num_workers = min(DEFAULT_NUM_WORKERS, len(cpus))
+    num_workers = max(1, min(num_workers, len(img_paths)))
+    if threads_per_worker is None:
+        threads_per_worker = max(1, len(cpus) // num_workers)
+
+    ctx = mp.get_context("fork")
+    cpu_sets = None
+    if pin_cores:
+        if threads_per_worker * num_workers > len(cpus):
+            raise ValueError(
+                f"Cannot pin {num_workers} workers to disjoint sets of {threads_per_worker} cores: only "
+                f"{len(cpus)} cores available. Lower num_workers or threads_per_worker, or pass pin_cores=False."
+            )
+        cpu_sets = ctx.Queue()
+        for i in range(num_workers):
+            cpu_sets.put(set(cpus[i * threads_per_worker:(i + 1) * threads_per_worker]))
+
+    if worker_fn is None:
+        worker_fn = _default_worker_fn(classes, num_patches, text_prompt)
+
+    # Публикуем состояние до fork, чтобы воркеры получили его без сериализации
+    _SHARED_STATE = share_internvl_state(state)
+    _WORKER_FN = worker_fn
+
+    results = [None] * len(img_paths)
+    try:
+        with ctx.Pool(
+            processes=num_workers,
+            initializer=_init_worker,
+            initargs=(threads_per_worker, cpu_sets),
+        ) as pool:
+            for index, result in pool.imap_unordered(_run_worker, enumerate(img_paths), chunksize=chunksize):
+                results[index] = result
+    finally:
+        _SHARED_STATE = None
+        _WORKER_FN = None
+
+    return results
@@ -0,0 +1,27 @@
+import re
+
+import pytest
+
+
+class StubTokenizer:
+    """Word-piece tokenizer stand-in: every space-prefixed word is one token, IDs are given on first use."""
+
+    def __init__(self, vocab_size=64):
+        self.vocab_size = vocab_size
+        self.vocab = {}
+        self.calls = []
+
+    def token_ids(self, text):
+        return [self.vocab.setdefault(piece, len(self.vocab) + 1) for piece in re.findall(r" ?[^ ]+", text)]
+
+    def __call__(self, texts, add_special_tokens=True):
+        self.calls.append(list(texts))
+        ids = [self.token_ids(text) for text in texts]
+        if max((t for text_ids in ids for t in text_ids), default=0) >= self.vocab_size:
+            raise ValueError("StubTokenizer vocabulary is full.")
+        return {"input_ids": ids}
+
+
+@pytest.fixture
+def tokenizer():
+    return StubTokenizer()
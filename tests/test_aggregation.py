@@ -0,0 +1,74 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from methods.aggregation import ConfidenceAggregator
+
+
+CLASSES = ["cat", "dog", "hot dog"]
+
+
+def _images(tokenizer, num_images=12, num_layers=4, num_tokens=9, seed=0):
+    rng = np.random.default_rng(seed)
+    for class_ in CLASSES:
+        tokenizer.token_ids(class_)
+    images = []
+    for i in range(num_images):
+        probs = rng.random((tokenizer.vocab_size, num_layers, num_tokens)) ** 8
+        probs = (probs / probs.sum(axis=0, keepdims=True) * 4).clip(0, 1).astype(np.float32)
+        labels = {class_ for class_ in CLASSES if rng.random() < 0.5}
+        images.append((probs, f"image_{i}.jpg", labels))
+    return images
+
+
+def _assert_same_summary(actual, expected):
+    assert actual["num_images"] == expected["num_images"]
+    for key in ("mean", "std", "max", "hit_rate", "precision", "recall"):
+        np.testing.assert_allclose(actual[key], expected[key], rtol=1e-12, atol=1e-15)
+    np.testing.assert_array_equal(actual["histogram"], expected["histogram"])
+    assert actual["top"] == expected["top"]
+
+
+def test_merge_matches_single_aggregator(tokenizer):
+    images = _images(tokenizer)
+    full = ConfidenceAggregator(tokenizer, CLASSES, top_n=3)
+    halves = [ConfidenceAggregator(tokenizer, CLASSES, top_n=3) for _ in range(2)]
+    for i, (probs, image_id, labels) in enumerate(images):
+        full.update(probs, image_id, labels=labels)
+        halves[i % 2].update(probs, image_id, labels=labels)
+
+    merged = halves[0].merge(halves[1])
+    _assert_same_summary(merged.summary(), full.summary())
+    np.testing.assert_array_equal(merged.confusion, full.confusion)
+
+
+def test_merge_into_empty(tokenizer):
+    images = _images(tokenizer, num_images=4)
+    full = ConfidenceAggregator(tokenizer, CLASSES)
+    for probs, image_id, labels in images:
+        full.update(probs, image_id, labels=labels)
+
+    merged = ConfidenceAggregator(tokenizer, CLASSES).merge(full)
+    _assert_same_summary(merged.summary(), full.summary())
+
+
+def test_pickle_round_trip(tokenizer):
+    images = _images(tokenizer)
+    full = ConfidenceAggregator(tokenizer, CLASSES, top_n=3)
+    worker = ConfidenceAggregator(tokenizer, CLASSES, top_n=3)
+    main = ConfidenceAggregator(tokenizer, CLASSES, top_n=3)
+    for i, (probs, image_id, labels) in enumerate(images):
+        full.update(probs, image_id, labels=labels)
+        (worker if i < 5 else main).update(probs, image_id, labels=labels)
+
+    # Агрегатор из воркера приходит без токенизатора, но сливается как обычно
+    restored = pickle.loads(pickle.dumps(worker))
+    assert restored.tokenizer is None
+    _assert_same_summary(restored.summary(), worker.summary())
+    _assert_same_summary(main.merge(restored).summary(), full.summary())
+
+
+def test_merge_rejects_other_classes(tokenizer):
+    with pytest.raises(ValueError):
+        ConfidenceAggregator(tokenizer, CLASSES).merge(ConfidenceAggregator(tokenizer, CLASSES[:2]))
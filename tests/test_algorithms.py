@@ -0,0 +1,24 @@
+import numpy as np
+
+from methods.algorithms import internal_confidence_segmentation
+
+
+def test_segmentation_grid_layout(tokenizer):
+    num_patches, columns, rows = 2, 3, 2
+    num_tiles = columns * rows
+    class_id = tokenizer.token_ids("cat")[0]
+
+    # Значение токена кодирует (тайл, строка и столбец внутри тайла)
+    tile, within = np.divmod(np.arange(num_tiles * num_patches ** 2), num_patches ** 2)
+    probs = np.zeros((tokenizer.vocab_size, 3, tile.size), dtype=np.float32)
+    probs[class_id] = (100 * tile + within) / 1000
+
+    segmentation = internal_confidence_segmentation(
+        tokenizer, probs, "cat", num_patches=num_patches, grid=(columns, rows)
+    )
+    assert segmentation.shape == (rows * num_patches, columns * num_patches)
+    for i in range(num_tiles):
+        row, column = i // columns, i % columns
+        block = segmentation[row * num_patches:(row + 1) * num_patches, column * num_patches:(column + 1) * num_patches]
+        expected = (100 * i + np.arange(num_patches ** 2).reshape(num_patches, num_patches)) / 1000
+        np.testing.assert_allclose(block, expected, rtol=1e-6)
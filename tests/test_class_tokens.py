@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+
+from methods.algorithms import internal_confidence, internal_confidence_heatmap, internal_confidence_segmentation
+from methods.class_tokens import _pluralize, class_probs, class_variants, encode_cached
+
+
+def _softmax_probs(vocab_size=64, num_layers=3, num_tokens=16, seed=0):
+    rng = np.random.default_rng(seed)
+    probs = rng.random((vocab_size, num_layers, num_tokens)).astype(np.float32)
+    return probs / probs.sum(axis=0, keepdims=True)
+
+
+@pytest.mark.parametrize(
+    "variants, expected",
+    [
+        (("plain",), ["hot dog"]),
+        (("space",), [" hot dog"]),
+        (("plain", "space"), ["hot dog", " hot dog"]),
+        (("plural",), ["hot dogs"]),
+        (("plain", "capitalized"), ["hot dog", "Hot dog"]),
+        (
+            ("space", "capitalized", "plural"),
+            # Без plain исключается только исходное написание, производные формы остаются
+            ["hot dogs", "Hot dog", "Hot dogs", " hot dog", " hot dogs", " Hot dog", " Hot dogs"],
+        ),
+    ],
+)
+def test_class_variants(variants, expected):
+    assert sorted(class_variants("hot dog", variants)) == sorted(expected)
+
+
+def test_unknown_variant():
+    with pytest.raises(ValueError):
+        class_variants("dog", ("upper",))
+
+
+@pytest.mark.parametrize(
+    "phrase, plural",
+    [("dog", "dogs"), ("bus", "buses"), ("box", "boxes"), ("bench", "benches"), ("pony", "ponies"),
+     ("toy", "toys"), ("hot dog", "hot dogs"), ("sports ball", "sports balls")],
+)
+def test_pluralize(phrase, plural):
+    assert _pluralize(phrase) == plural
+
+
+@pytest.mark.parametrize(
+    "aggregation, reduce",
+    [
+        ("first", lambda rows: rows[0]),
+        ("max", lambda rows: rows.max(axis=0)),
+        ("product", lambda rows: rows.prod(axis=0)),
+    ],
+)
+def test_aggregation_of_multi_token_class(tokenizer, aggregation, reduce):
+    probs = _softmax_probs()
+    ids = tokenizer.token_ids("hot dog")
+    assert len(ids) == 2
+
+    result = class_probs(tokenizer, probs, ["hot dog", "cat"], aggregation=aggregation)
+    assert result.shape == (2,) + probs.shape[1:]
+    np.testing.assert_allclose(result[0], reduce(probs[ids]))
+    np.testing.assert_allclose(result[1], probs[tokenizer.token_ids("cat")[0]])
+
+
+def test_max_over_variants(tokenizer):
+    probs = _softmax_probs()
+    result = class_probs(tokenizer, probs, "dog", variants=("plain", "space"))
+    expected = np.maximum(probs[tokenizer.token_ids("dog")[0]], probs[tokenizer.token_ids(" dog")[0]])
+    np.testing.assert_allclose(result[0], expected)
+
+
+@pytest.mark.parametrize("class_", ["cat", "hot dog"])
+def test_internal_confidence_matches_baseline(tokenizer, class_):
+    probs = _softmax_probs(num_tokens=16)
+    ids = tokenizer.token_ids(class_)
+
+    # Исходные реализации: максимум по строкам словаря всех токенов класса
+    assert internal_confidence(tokenizer, probs, class_) == probs[ids].max()
+    np.testing.assert_array_equal(internal_confidence_heatmap(tokenizer, probs, class_), probs[ids].max(axis=0).T)
+    np.testing.assert_array_equal(
+        internal_confidence_segmentation(tokenizer, probs, class_, num_patches=4),
+        probs[ids].max(axis=0).max(axis=0).reshape(4, 4).astype(float),
+    )
+
+
+def test_encode_cached_tokenizes_new_strings_once(tokenizer):
+    assert encode_cached(tokenizer, ["cat", "dog", "cat"]) == [[1], [2], [1]]
+    assert encode_cached(tokenizer, ["dog", "hot dog"]) == [[2], [3, 4]]
+    assert encode_cached(tokenizer, ["cat", "hot dog"]) == [[1], [3, 4]]
+    assert tokenizer.calls == [["cat", "dog"], ["hot dog"]]
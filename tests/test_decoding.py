@@ -0,0 +1,64 @@
+import types
+
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+pytest.importorskip("torchvision")
+pytest.importorskip("PIL")
+
+from methods.internvl_utils import decode_internvl
+
+
+@pytest.fixture
+def model():
+    torch.manual_seed(0)
+    config = transformers.Qwen2Config(
+        vocab_size=50, hidden_size=32, intermediate_size=64, num_hidden_layers=2, num_attention_heads=4,
+        num_key_value_heads=2,
+    )
+    # Достаточно language_model и device, как у InternVLChatModel
+    return types.SimpleNamespace(language_model=transformers.Qwen2ForCausalLM(config).eval(), device=torch.device("cpu"))
+
+
+def _prefill(model):
+    input_ids = torch.tensor([[1, 2, 3, 4]])
+    attention_mask = torch.ones_like(input_ids)
+    return input_ids, attention_mask, model.language_model(input_ids=input_ids, attention_mask=attention_mask, use_cache=True)
+
+
+def test_greedy_matches_generate(model):
+    with torch.inference_mode():
+        input_ids, attention_mask, output = _prefill(model)
+        expected = model.language_model.generate(
+            input_ids, attention_mask=attention_mask, max_new_tokens=8, do_sample=False, pad_token_id=0
+        )[0, input_ids.shape[1]:].tolist()
+        steps = list(decode_internvl(model, output, attention_mask, eos_token_id=-1, max_new_tokens=8))
+
+    assert [step["token_ids"].item() for step in steps] == expected
+
+
+def test_forked_streams(model):
+    with torch.inference_mode():
+        _, attention_mask, output = _prefill(model)
+        greedy = [step["token_ids"].item() for step in decode_internvl(model, output, attention_mask, -1, max_new_tokens=6)]
+
+        _, attention_mask, output = _prefill(model)
+        steps = list(decode_internvl(model, output, attention_mask, -1, temperatures=[0.0, 1.0, 0.0], max_new_tokens=6))
+    token_ids = torch.stack([step["token_ids"] for step in steps], dim=1).tolist()
+
+    assert token_ids[0] == greedy
+    assert token_ids[2] == greedy
+    assert all(step["logprobs"].shape == (3,) for step in steps)
+
+
+def test_finished_streams_emit_eos(model):
+    with torch.inference_mode():
+        _, attention_mask, output = _prefill(model)
+        first = next(decode_internvl(model, output, attention_mask, -1))["token_ids"].item()
+
+        _, attention_mask, output = _prefill(model)
+        steps = list(decode_internvl(model, output, attention_mask, first, temperatures=[0.0, 1.0], max_new_tokens=5))
+
+    # Жадный поток завершается на первом шаге и дальше выдаёт только eos
+    assert all(step["token_ids"][0].item() == first for step in steps)
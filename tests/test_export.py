@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+pa = pytest.importorskip("pyarrow")
+pq = pytest.importorskip("pyarrow.parquet")
+
+from methods.export import ScoreParquetWriter, prompt_hash
+
+
+def _heatmap(seed, num_tokens=6, num_layers=3):
+    return np.random.default_rng(seed).random((num_tokens, num_layers)).astype(np.float32)
+
+
+def test_heatmap_layout(tmp_path):
+    path = tmp_path / "scores.parquet"
+    heatmap = _heatmap(0)
+    with ScoreParquetWriter(path) as writer:
+        writer.write_scores("a.jpg", "Describe.", "cat", heatmap, kind="heatmap")
+
+    table = pq.read_table(path).to_pydict()
+    num_tokens, num_layers = heatmap.shape
+    assert table["image_id"] == ["a.jpg"] * heatmap.size
+    assert table["prompt_hash"] == [prompt_hash("Describe.")] * heatmap.size
+    assert table["class"] == ["cat"] * heatmap.size
+    # Строки упорядочены по (layer, token)
+    assert table["layer"] == [layer for layer in range(num_layers) for _ in range(num_tokens)]
+    assert table["token"] == list(range(num_tokens)) * num_layers
+    np.testing.assert_array_equal(table["score"], heatmap.T.ravel())
+    np.testing.assert_array_equal(table["layer_max"], np.repeat(heatmap.max(axis=0), num_tokens))
+
+
+def test_confidence_and_segmentation_layout(tmp_path):
+    path = tmp_path / "scores.parquet"
+    segmentation = _heatmap(1, num_tokens=2, num_layers=3)
+    with ScoreParquetWriter(path, include_layer_max=False) as writer:
+        writer.write_scores("a.jpg", None, "cat", np.float32(0.25))
+        writer.write_scores("a.jpg", None, "cat", segmentation, kind="segmentation")
+
+    table = pq.read_table(path).to_pydict()
+    assert "layer_max" not in table
+    assert table["layer"] == [-1] * 7
+    assert table["token"] == [-1] + list(range(6))
+    # Токен сегментационной карты - индекс патча row * width + column
+    np.testing.assert_array_equal(table["score"], [0.25] + list(segmentation.ravel()))
+
+
+def test_two_dimensional_scores_require_kind(tmp_path):
+    with ScoreParquetWriter(tmp_path / "scores.parquet") as writer:
+        with pytest.raises(ValueError):
+            writer.write_scores("a.jpg", None, "cat", _heatmap(0))
+        with pytest.raises(ValueError):
+            writer.write_scores("a.jpg", None, "cat", np.float32(0.5), kind="heatmap")
+        with pytest.raises(ValueError):
+            writer.write_scores("a.jpg", None, "cat", np.zeros((2, 2, 2)), kind="segmentation")
+
+
+def test_dictionary_columns_across_row_groups(tmp_path):
+    path = tmp_path / "scores.parquet"
+    expected = []
+    with ScoreParquetWriter(path, row_group_size=40) as writer:
+        for i in range(5):
+            for class_ in ("cat", "dog", "hot dog"):
+                image_id, prompt = f"image_{i % 3}.jpg", f"prompt {i % 2}"
+                writer.write_scores(image_id, prompt, class_, _heatmap(i), kind="heatmap")
+                expected += [(image_id, prompt_hash(prompt), class_)] * _heatmap(i).size
+
+    parquet_file = pq.ParquetFile(path)
+    assert parquet_file.num_row_groups > 1
+    table = parquet_file.read()
+    for name in ("image_id", "prompt_hash", "class"):
+        assert pa.types.is_dictionary(table.schema.field(name).type)
+    assert list(zip(*(table[name].to_pylist() for name in ("image_id", "prompt_hash", "class")))) == expected
+
+    # Фильтр по словарной колонке и слою
+    filtered = pq.read_table(path, filters=[("class", "=", "dog"), ("layer", "=", 1)])
+    assert set(filtered["class"].to_pylist()) == {"dog"}
+    assert filtered.num_rows == 5 * 6
@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+
+from methods.lens_codecs import CODECS, codec_error_bound, encode_logit_lens, load_logit_lens
+
+
+def _softmax_probs(vocab_size=5000, num_layers=4, num_tokens=7, seed=0):
+    rng = np.random.default_rng(seed)
+    logits = rng.normal(scale=4.0, size=(num_layers, num_tokens, vocab_size))
+    probs = np.exp(logits - logits.max(axis=-1, keepdims=True))
+    probs /= probs.sum(axis=-1, keepdims=True)
+    # (vocab_size, num_layers, num_tokens), как в retrieve_logit_lens_internvl
+    probs = probs.transpose(2, 0, 1).astype(np.float32)
+    probs[:, 0, 0] = 0
+    probs[0, 0, 0] = 1
+    return probs
+
+
+def _check_bound(codec, probs, decoded, threshold=None):
+    rel, abs_ = codec_error_bound(codec)
+    if codec.startswith("log_"):
+        # Абсолютная часть границы лог-кодеков задана относительно максимума столбца (layer, token)
+        abs_ = abs_ * probs.max(axis=0, keepdims=True)
+    bound = np.maximum(rel * probs.astype(np.float64), abs_)
+    error = np.abs(decoded.astype(np.float64) - probs)
+
+    kept = np.ones(probs.shape, dtype=bool) if threshold is None else probs >= threshold
+    assert (error[kept] <= bound[kept]).all()
+    if threshold is not None:
+        assert (decoded[~kept] == 0).all()
+
+
+@pytest.mark.parametrize("codec", CODECS)
+@pytest.mark.parametrize("threshold", [None, 1e-4])
+def test_round_trip_within_error_bound(codec, threshold):
+    probs = _softmax_probs()
+    encoded = encode_logit_lens(probs, codec=codec, threshold=threshold)
+    decoded = encoded.decode()
+
+    assert decoded.shape == probs.shape
+    assert decoded.dtype == np.float32
+    _check_bound(codec, probs, decoded, threshold)
+
+
+def test_compression_ratio():
+    probs = _softmax_probs()
+    assert encode_logit_lens(probs, "float16").nbytes * 2 == probs.nbytes
+    assert encode_logit_lens(probs, "log_uint8").nbytes < probs.nbytes / 3.5
+
+
+@pytest.mark.parametrize("threshold", [None, 1e-4])
+def test_getitem_rows(threshold):
+    probs = _softmax_probs()
+    encoded = encode_logit_lens(probs, "log_uint16", threshold=threshold)
+    decoded = encoded.decode()
+
+    np.testing.assert_array_equal(encoded[[3, 17, 3]], decoded[[3, 17, 3]])
+    np.testing.assert_array_equal(encoded[17], decoded[17])
+    np.testing.assert_array_equal(encoded[-1], decoded[-1])
+    np.testing.assert_array_equal(encoded[[-2, 5]], decoded[[-2, 5]])
+    np.testing.assert_array_equal(encoded[10:20], decoded[10:20])
+    np.testing.assert_array_equal(encoded[17, 2], decoded[17, 2])
+    np.testing.assert_array_equal(encoded[[3, 17], :, 4], decoded[[3, 17], :, 4])
+    assert encoded[17].shape == probs.shape[1:]
+
+
+@pytest.mark.parametrize("codec", CODECS)
+@pytest.mark.parametrize("threshold", [None, 1e-4])
+def test_save_load(tmp_path, codec, threshold):
+    probs = _softmax_probs(vocab_size=300)
+    encoded = encode_logit_lens(probs, codec=codec, threshold=threshold)
+    path = tmp_path / "lens.npz"
+    encoded.save(path)
+
+    loaded = load_logit_lens(path)
+    assert loaded.codec == codec
+    assert loaded.shape == probs.shape
+    assert loaded.threshold == threshold
+    np.testing.assert_array_equal(loaded.decode(), encoded.decode())
+
+
+def test_unknown_codec():
+    with pytest.raises(ValueError):
+        encode_logit_lens(_softmax_probs(vocab_size=10), codec="int4")
@@ -0,0 +1,51 @@
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("torchvision")
+pytest.importorskip("transformers")
+Image = pytest.importorskip("PIL.Image")
+
+from methods.internvl_utils import dynamic_preprocess, plan_batch_tiles, plan_tiles
+
+
+IMAGE_SIZES = [(2000, 1500), (500, 400), (3000, 800), (1800, 900), (4000, 4000), (300, 2400)]
+
+
+@pytest.mark.parametrize("num_tiles", range(len(IMAGE_SIZES), 40))
+def test_batch_plan_within_budget(num_tiles):
+    token_budget = num_tiles * 256 + 100
+    plans = plan_batch_tiles(IMAGE_SIZES, token_budget, num_image_token=256)
+
+    assert len(plans) == len(IMAGE_SIZES)
+    assert sum(plan["num_tiles"] for plan in plans) <= token_budget // 256
+    for plan in plans:
+        assert plan["num_tiles"] == plan["grid"][0] * plan["grid"][1]
+
+
+def test_batch_plan_uses_budget_when_images_need_it():
+    # Каждому изображению нужно 12 тайлов, бюджета хватает всем
+    plans = plan_batch_tiles([(4000, 3000)] * 2, 24 * 256, num_image_token=256)
+    assert [plan["num_tiles"] for plan in plans] == [12, 12]
+
+
+def test_batch_plan_below_one_tile_per_image():
+    with pytest.raises(ValueError):
+        plan_batch_tiles(IMAGE_SIZES, (len(IMAGE_SIZES) - 1) * 256, num_image_token=256)
+
+
+def test_tile_budget_below_min_num():
+    with pytest.raises(ValueError):
+        plan_tiles(1000, 1000, max_tiles=0)
+    with pytest.raises(ValueError):
+        plan_tiles(1000, 1000, min_num=2, max_tiles=1)
+
+
+@pytest.mark.parametrize("use_thumbnail", [False, True])
+@pytest.mark.parametrize("max_tiles", [1, 3, 6, 12])
+def test_dynamic_preprocess_follows_plan(use_thumbnail, max_tiles):
+    image = Image.new("RGB", (1200, 500))
+    tile_plan = plan_tiles(*image.size, image_size=112, max_tiles=max_tiles, use_thumbnail=use_thumbnail)
+    tiles = dynamic_preprocess(image, image_size=112, tile_plan=tile_plan)
+
+    assert len(tiles) == tile_plan["num_tiles"]
+    assert all(tile.size == (112, 112) for tile in tiles)
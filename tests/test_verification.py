@@ -0,0 +1,49 @@
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("torchvision")
+pytest.importorskip("transformers")
+pytest.importorskip("PIL")
+
+from methods.verification import _singularize, extract_caption_objects
+
+
+@pytest.mark.parametrize(
+    "caption, expected",
+    [
+        # Составные названия имеют приоритет над отдельными словами
+        ("Two traffic lights over a road.", [("traffic light", "traffic light")]),
+        ("A hot dog next to a dog.", [("hot dog", "hot dog"), ("dog", "dog")]),
+        ("A teddy bear and a bear.", [("teddy bear", "teddy bear"), ("bear", "bear")]),
+        # Неправильные формы множественного числа
+        ("Knives and mice.", [("knife", "knife"), ("mouse", "mouse")]),
+        ("People wearing glasses.", [("people", "person"), ("glass", "wine glass")]),
+        # Повторы и синонимы одного класса
+        ("A dog, another dog and two dogs.", [("dog", "dog")]),
+        ("A man and a woman.", [("man", "person"), ("woman", "person")]),
+        ("A bus with a glass of wine near a tennis racket.",
+         [("bus", "bus"), ("glass", "wine glass"), ("tennis racket", "tennis racket")]),
+        ("A quiet empty street.", []),
+    ],
+)
+def test_extract_caption_objects(caption, expected):
+    assert extract_caption_objects(caption) == expected
+
+
+@pytest.mark.parametrize(
+    "word, singular",
+    [
+        ("knives", "knife"), ("mice", "mouse"), ("glasses", "glass"), ("people", "people"),
+        ("buses", "bus"), ("benches", "bench"), ("ponies", "pony"), ("cats", "cat"),
+        # Слова, которые нельзя портить
+        ("bus", "bus"), ("glass", "glass"), ("tennis", "tennis"), ("skis", "skis"), ("scissors", "scissors"),
+        ("dog", "dog"), ("gas", "gas"),
+    ],
+)
+def test_singularize(word, singular):
+    assert _singularize(word) == singular
+
+
+def test_custom_lexicon():
+    lexicon = {"red panda": "panda", "panda": "panda"}
+    assert extract_caption_objects("Red pandas and a panda.", lexicon) == [("red panda", "panda"), ("panda", "panda")]